@@ -14,13 +14,42 @@ from .cssfield_selection import calculate_footprint_probabilities
 from .models import CredibleRegionContour, Profile
 from astropy.table import Table
 from io import BytesIO
+from concurrent.futures import Future, ThreadPoolExecutor
 import astropy_healpix as ah
 import numpy as np
 import traceback
+import functools
+import time
+import threading
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
-twilio_client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+# reuse the connections to Slack between alerts (one session per thread, since requests.Session is not thread-safe),
+# and share one pool of threads for posting to several workspaces
+SLACK_SESSIONS = threading.local()
+SLACK_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+SLACK_MAX_RETRY_AFTER = 30.  # seconds; never block a worker for longer than this on a rate-limited post
+# remember recently posted messages, so that duplicate alerts (e.g., redelivered by Kafka) are only posted once
+RECENT_SLACK_MESSAGES = OrderedDict()  # (url, text) -> time.monotonic() when posted
+SLACK_MESSAGES_IN_FLIGHT = {}  # (url, text) -> Future with whether the post that is still running succeeded
+RECENT_SLACK_MESSAGES_LOCK = threading.Lock()  # guards both of the above
+RECENT_SLACK_MESSAGES_MAX = 2048
+SLACK_DUPLICATE_WINDOW = 300.  # seconds
+
+
+def get_slack_session():
+    """Get the session for this thread, creating it the first time this thread posts to Slack"""
+    if not hasattr(SLACK_SESSIONS, 'session'):
+        SLACK_SESSIONS.session = requests.Session()
+    return SLACK_SESSIONS.session
+
+
+@functools.cache
+def get_twilio_client():
+    """Create the Twilio client the first time a text is sent, rather than whenever this module is imported"""
+    return Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+
 
 ALERT_TEXT_INTRO = """{{most_likely_class}} {{seq.event_subtype}} v{{seq.sequence_id}}
 {{nle.event_id}} ({{significance}})
@@ -82,7 +111,55 @@ def send_text(body, is_test_alert=False, is_significant=True, is_burst=False, ha
         else:
             subscribed = user.bbh_alerts
         if subscribed and user.phone_number is not None:
-            twilio_client.messages.create(body=body_ascii, from_=settings.ALERT_SMS_FROM, to=user.phone_number.as_e164)
+            get_twilio_client().messages.create(body=body_ascii, from_=settings.ALERT_SMS_FROM,
+                                                to=user.phone_number.as_e164)
+
+
+def post_to_slack(url, text):
+    """
+    Post a plain text message to a Slack incoming webhook, unless the same message was posted to the same webhook
+    recently. If it is being posted right now, wait for that post and return its outcome instead of posting it again.
+    """
+    key = (url, text)
+    with RECENT_SLACK_MESSAGES_LOCK:
+        posted = RECENT_SLACK_MESSAGES.get(key)
+        if posted is not None and time.monotonic() - posted < SLACK_DUPLICATE_WINDOW:
+            logger.info(f'Skipping duplicate Slack message: {text}')
+            return True
+        in_flight = SLACK_MESSAGES_IN_FLIGHT.get(key)
+        if in_flight is None:
+            SLACK_MESSAGES_IN_FLIGHT[key] = Future()
+    if in_flight is not None:
+        logger.info(f'Waiting for duplicate Slack message to be posted: {text}')
+        return in_flight.result()
+
+    ok = False
+    try:
+        ok = _post_to_slack(url, text)
+        return ok
+    finally:  # only remember the message once it has been delivered, so that a failed one can be sent again
+        with RECENT_SLACK_MESSAGES_LOCK:
+            in_flight = SLACK_MESSAGES_IN_FLIGHT.pop(key)
+            if ok:
+                RECENT_SLACK_MESSAGES[key] = time.monotonic()
+                RECENT_SLACK_MESSAGES.move_to_end(key)
+                if len(RECENT_SLACK_MESSAGES) > RECENT_SLACK_MESSAGES_MAX:
+                    RECENT_SLACK_MESSAGES.popitem(last=False)
+        in_flight.set_result(ok)
+
+
+def _post_to_slack(url, text):
+    """Send the message, retrying once if rate limited, and return whether Slack accepted it"""
+    json_data = json.dumps({'text': text}).encode('ascii')
+    response = get_slack_session().post(url, data=json_data, headers={'Content-Type': 'application/json'})
+    if response.status_code == 429:  # Slack allows about one message per second per webhook, so wait and retry once
+        retry_after = min(float(response.headers.get('Retry-After', 1.)), SLACK_MAX_RETRY_AFTER)
+        logger.warning(f'Slack rate limit reached, retrying in {retry_after:.0f} s')
+        time.sleep(retry_after)
+        response = get_slack_session().post(url, data=json_data, headers={'Content-Type': 'application/json'})
+    if not response.ok:
+        logger.error(f'Could not post to Slack ({response.status_code}): {response.text}\nMessage: {text}')
+    return response.ok
 
 
 def send_slack(body, format_kwargs, is_test_alert=False, is_significant=True, is_burst=False, has_ns=True,
@@ -99,14 +176,19 @@ def send_slack(body, format_kwargs, is_test_alert=False, is_significant=True, is
         channel = 3
     if at is not None:
         body = f'<!{at}>\n' + body
-    headers = {'Content-Type': 'application/json'}
+    urls = []
+    bodies = []
     for url_list, (nle_link, service), (target_link, _) in zip(settings.SLACK_URLS, settings.NLE_LINKS, settings.TARGET_LINKS):
         body_slack = body.format(nle_link=nle_link, service=service, target_link=target_link).format(**format_kwargs)
         logger.info(f'Sending GW alert: {body_slack}')
-        json_data = json.dumps({'text': body_slack})
-        requests.post(url_list[channel], data=json_data.encode('ascii'), headers=headers)
+        urls.append(url_list[channel])
+        bodies.append(body_slack)
         if not all_workspaces:
             break
+    # each workspace is a separate round trip to Slack, so post to all of them at once
+    n_failed = list(SLACK_EXECUTOR.map(post_to_slack, urls, bodies)).count(False)  # also raises any errors
+    if n_failed:
+        logger.error(f'Failed to send GW alert to {n_failed:d} of {len(urls):d} Slack workspaces')
 
 
 def send_email(subject, body, is_test_alert=False):
@@ -133,20 +215,23 @@ def send_email(subject, body, is_test_alert=False):
 
 def calculate_credible_region(skymap, localization, probability=0.9):
     """store the credible region contour for skymap plotting"""
+    # Work on contiguous column arrays rather than the Table, which also leaves the skymap unmodified for later use
+    uniq = np.ascontiguousarray(skymap['UNIQ'])
+    probdensity = np.ascontiguousarray(skymap['PROBDENSITY'], dtype=np.float64)
     # Sort the pixels of the sky map by descending probability density
-    skymap.sort('PROBDENSITY', reverse=True)
+    order = np.argsort(probdensity)[::-1]
+    level, ipix = ah.uniq_to_level_ipix(uniq[order])
     # Find the area of each pixel
-    skymap['level'], skymap['ipix'] = ah.uniq_to_level_ipix(skymap['UNIQ'])
-    pixel_area = ah.nside_to_pixel_area(ah.level_to_nside(skymap['level']))
+    pixel_area = ah.nside_to_pixel_area(ah.level_to_nside(level)).to_value('sr')
     # Calculate the probability within each pixel: the pixel area times the probability density
-    prob = pixel_area * skymap['PROBDENSITY']
+    prob = pixel_area * probdensity[order]
     # Calculate the cumulative sum of the probability
     cumprob = np.cumsum(prob)
     # Find the pixel for which the probability sums to 0.9
     index_90 = cumprob.searchsorted(probability)
-    # Find the pixels included in this sum
-    skymap90 = skymap[:index_90].group_by('level')
-    credible_region_90 = {str(group['level'][0]): [ipix.item() for ipix in group['ipix']] for group in skymap90.groups}
+    # Find the pixels included in this sum, grouped by level
+    level90, ipix90 = level[:index_90], ipix[:index_90]
+    credible_region_90 = {str(lvl): ipix90[level90 == lvl].tolist() for lvl in np.unique(level90)}
     if 'MOCORDER' in skymap.meta:
         credible_region_90.setdefault(str(skymap.meta['MOCORDER']), [])  # must include the highest order
     # Create the CredibleRegionContour object
@@ -155,12 +240,14 @@ def calculate_credible_region(skymap, localization, probability=0.9):
 
 
 def pick_slack_channel(seq):
+    details = seq.details
+    classification = details['classification']
     is_test_alert = seq.nonlocalizedevent.event_id.startswith('M')
-    is_significant = seq.details['significant']
-    is_burst = seq.details['group'] == 'Burst'
-    has_ns = seq.details['properties'].get('HasNS', 0.) >= 0.01 \
-             or seq.details['classification'].get('BNS', 0.) >= 0.01 \
-             or seq.details['classification'].get('NSBH', 0.) >= 0.01
+    is_significant = details['significant']
+    is_burst = details['group'] == 'Burst'
+    has_ns = details['properties'].get('HasNS', 0.) >= 0.01 \
+             or classification.get('BNS', 0.) >= 0.01 \
+             or classification.get('NSBH', 0.) >= 0.01
     return is_test_alert, is_significant, is_burst, has_ns
 
 
@@ -305,7 +392,6 @@ def handle_einstein_probe_alert(message, metadata):
             calculate_footprint_probabilities(skymap, localization)
 
     slack_alert = f'Received Einstein Probe trigger <{settings.NLE_LINKS[0][0]}|{{nle.event_id}}>'
-    json_data = json.dumps({'text': slack_alert.format(nle=nonlocalizedevent)}).encode('ascii')
-    requests.post(settings.SLACK_EP_URL, data=json_data, headers={'Content-Type': 'application/json'})
+    post_to_slack(settings.SLACK_EP_URL, slack_alert.format(nle=nonlocalizedevent))
 
     logger.info(f'Finished processing alert for {nonlocalizedevent.event_id}')
@@ -101,23 +101,32 @@ class ClippedStackedAtlasProcessor(AtlasProcessor):
             raise InvalidFileFormatException('Empty table or invalid file type')
 
         try:
-            for datum in data:
-                time = Time(datum['mjd'], format='mjd')
-                utc = TimezoneInfo(utc_offset=0*units.hour)
-                time.format = 'datetime'
+            utc = TimezoneInfo(utc_offset=0*units.hour)
+            timestamps = Time([datum['mjd'] for datum in data], format='mjd').to_datetime(timezone=utc)
+            uJy = np.array([datum['uJy'] for datum in data], dtype=float)
+            duJy = np.array([datum['duJy'] for datum in data], dtype=float)
+
+            # If the signal is in the noise, calculate the non-detection limit from the reported flux uncertainty.
+            # see https://fallingstar-data.com/forcedphot/resultdesc/
+            with np.errstate(divide='ignore', invalid='ignore'):
+                signal_to_noise = uJy / duJy
+                # a NaN S/N is not below the cutoff, so it stays a (NaN) magnitude rather than becoming a limit
+                detected = (signal_to_noise > signal_to_noise_cutoff) | np.isnan(signal_to_noise)
+                mags = np.where(detected, 23.9 - 2.5 * np.log10(uJy), np.nan)
+                errs = 2.5 / np.log(10.) / signal_to_noise
+                limits = 23.9 - 2.5 * np.log10(signal_to_noise_cutoff * duJy)
+
+            for i, datum in enumerate(data):
                 value = {
-                    'timestamp': time.to_datetime(timezone=utc),
+                    'timestamp': timestamps[i],
                     'filter': str(datum['F']),
                     'telescope': 'ATLAS',
                 }
-                # If the signal is in the noise, calculate the non-detection limit from the reported flux uncertainty.
-                # see https://fallingstar-data.com/forcedphot/resultdesc/
-                signal_to_noise = datum['uJy'] / datum['duJy']
-                if signal_to_noise <= signal_to_noise_cutoff:
-                    value['limit'] = 23.9 - 2.5 * np.log10(signal_to_noise_cutoff * datum['duJy'])
+                if detected[i]:
+                    value['magnitude'] = mags[i]
+                    value['error'] = errs[i]
                 else:
-                    value['magnitude'] = 23.9 - 2.5 * np.log10(datum['uJy'])
-                    value['error'] = 2.5 / np.log(10.) / signal_to_noise
+                    value['limit'] = limits[i]
 
                 photometry.append(value)
         except Exception as e:
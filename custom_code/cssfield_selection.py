@@ -1,3 +1,4 @@
+import math
 import numpy as np
 import healpy
 from ligo.skymap import bayestar
@@ -54,17 +55,18 @@ def ra_dec_to_uvec(ra, dec):
 
 
 def uvec_to_ra_dec(x, y, z):
-    r = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+    # this is called with scalars, for which the math module is much faster than NumPy
+    r = math.sqrt(x ** 2 + y ** 2 + z ** 2)
     x /= r
     y /= r
     z /= r
-    theta = np.arctan2(y, x)
-    phi = np.arccos(z)
-    dec = 90 - np.rad2deg(phi)
+    theta = math.atan2(y, x)
+    phi = math.acos(min(max(z, -1.), 1.))  # guard against rounding just outside [-1, 1]
+    dec = 90 - math.degrees(phi)
     if theta < 0:
-        ra = 360 + np.rad2deg(theta)
+        ra = 360 + math.degrees(theta)
     else:
-        ra = np.rad2deg(theta)
+        ra = math.degrees(theta)
     return ra, dec
 
 
@@ -100,17 +102,13 @@ def calculate_footprint_probabilities(skymap, localization):
     flat = bayestar.rasterize(skymap)
     probs = healpy.reorder(flat['PROB'], 'NESTED', 'RING')
     nside = healpy.npix2nside(len(probs))
-    for cr in localization.surveyfieldcredibleregions.all():
+    for cr in localization.surveyfieldcredibleregions.select_related('survey_field'):
         pointing_footprint = project_footprint(CSS_FOOTPRINT, cr.survey_field.ra, cr.survey_field.dec)
-        ras_poly = [x[0] for x in pointing_footprint][:-1]
-        decs_poly = [x[1] for x in pointing_footprint][:-1]
+        ras_poly, decs_poly = np.asarray(pointing_footprint)[:-1].T
         xyzpoly = spherical_to_cartesian(1, np.deg2rad(decs_poly), np.deg2rad(ras_poly))
         qp = healpy.query_polygon(nside, np.array(xyzpoly).T)
-        prob = 0
-        for ind in qp:
-            prob += probs[ind]
-        cr.probability_contained = prob
-        cr.save()
+        cr.probability_contained = probs[qp].sum()  # sum the pixels in one call rather than indexing each one
+        cr.save(update_fields=['probability_contained'])
     logger.info('Updated probabilities for CSS fields')
 
 
@@ -12,6 +12,8 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+ARCHIVE_SESSION = requests.Session()  # reuse the connection to the LCO archive across downloads
+
 
 class CustomLCOFacility(LCOFacility):
     def save_data_products(self, observation_record, product_id=None):
@@ -26,7 +28,7 @@ class CustomLCOFacility(LCOFacility):
                 data_product_type='LCO',  # same as the built-in method except for this line
             )
             if created:
-                product_data = requests.get(product['url']).content
+                product_data = ARCHIVE_SESSION.get(product['url']).content
                 dfile = ContentFile(product_data)
                 dp.data.save(product['filename'], dfile)
                 dp.save()
@@ -4,6 +4,7 @@ from tom_surveys.models import SurveyField
 import json
 from django.conf import settings
 from django.db.models import Q
+from django.utils import timezone
 import functools
 import operator
 from datetime import datetime, timedelta
@@ -57,7 +58,7 @@ class LocalizationFilter(django_filters.Filter):
             if seq is None or seq.details is None:
                 return queryset.none()
             tmin = datetime.strptime(seq.details['time'], '%Y-%m-%dT%H:%M:%S.%f%z')
-            tmax = datetime.now(tmin.tzinfo) if dt is None else tmin + timedelta(days=dt)
+            tmax = timezone.now() if dt is None else tmin + timedelta(days=dt)
             if queryset.model == Candidate:
                 filter_kwargs = {
                     'observation_record__survey_field__credibleregions__localization': seq.localization,
@@ -7,7 +7,6 @@ from sqlalchemy.orm import declarative_base, Session
 from tom_nonlocalizedevents.models import EventCandidate, EventLocalization, SkymapTile
 from tom_nonlocalizedevents.healpix_utils import sa_engine, SaSkymapTile, uniq_to_bigintrange
 from tom_nonlocalizedevents.healpix_utils import update_all_credible_region_percents_for_candidates
-from tom_surveys.models import SurveyField
 from tom_targets.models import Target
 from .models import SurveyFieldCredibleRegion
 import numpy as np
@@ -23,6 +22,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 CREDIBLE_REGION_PROBABILITIES = sorted(json.loads(settings.CREDIBLE_REGION_PROBABILITIES), reverse=True)
+SKYMAP_TILE_BATCH_SIZE = 5000  # rows per INSERT; each tile only binds 3 parameters, well below PostgreSQL's 65535
 
 Base = declarative_base()
 
@@ -33,33 +33,46 @@ class SaSurveyField(Base):
     healpix = sa.Column(Point)
 
 
+def cumulative_probability_subquery(localization_id):
+    """
+    Subquery of the skymap tiles of a localization with the cumulative probability contained in all tiles of equal or
+    higher probability density
+    """
+    cum_prob = sa.func.sum(
+        SaSkymapTile.probdensity * SaSkymapTile.tile.area
+    ).over(
+        order_by=SaSkymapTile.probdensity.desc()
+    ).label(
+        'cum_prob'
+    )
+
+    return sa.select(
+        SaSkymapTile.probdensity,
+        cum_prob
+    ).filter(
+        SaSkymapTile.localization_id == localization_id
+    ).subquery()
+
+
+def min_probdensity_subquery(subquery, prob):
+    """Scalar subquery of the lowest probability density within the ``prob`` credible region"""
+    return sa.select(
+        sa.func.min(subquery.columns.probdensity)
+    ).filter(
+        subquery.columns.cum_prob <= prob
+    ).scalar_subquery()
+
+
 def update_all_credible_region_percents_for_survey_fields(eventlocalization):
     """
     This function creates a credible region linkage for each of the survey fields in the event localization specified
     """
     with Session(sa_engine) as session:
 
-        cum_prob = sa.func.sum(
-            SaSkymapTile.probdensity * SaSkymapTile.tile.area
-        ).over(
-            order_by=SaSkymapTile.probdensity.desc()
-        ).label(
-            'cum_prob'
-        )
-
-        subquery = sa.select(
-            SaSkymapTile.probdensity,
-            cum_prob
-        ).filter(
-            SaSkymapTile.localization_id == eventlocalization.id
-        ).subquery()
+        subquery = cumulative_probability_subquery(eventlocalization.id)
 
         for prob in CREDIBLE_REGION_PROBABILITIES:
-            min_probdensity = sa.select(
-                sa.func.min(subquery.columns.probdensity)
-            ).filter(
-                subquery.columns.cum_prob <= prob
-            ).scalar_subquery()
+            min_probdensity = min_probdensity_subquery(subquery, prob)
 
             query = sa.select(
                 SaSurveyField.name
@@ -73,7 +86,7 @@ def update_all_credible_region_percents_for_survey_fields(eventlocalization):
 
             for sa_survey_field in results:
                 SurveyFieldCredibleRegion.objects.update_or_create(
-                    survey_field = SurveyField.objects.get(name=sa_survey_field[0]),
+                    survey_field_id=sa_survey_field[0],  # the name is the primary key, so no need to fetch the field
                     localization=eventlocalization,
                     defaults={
                         'smallest_percent': int(prob * 100.0)
@@ -102,26 +115,8 @@ def create_candidates_from_targets(eventsequence, prob=0.95, target_ids=None):
 
     with Session(sa_engine) as session:
 
-        cum_prob = sa.func.sum(
-            SaSkymapTile.probdensity * SaSkymapTile.tile.area
-        ).over(
-            order_by=SaSkymapTile.probdensity.desc()
-        ).label(
-            'cum_prob'
-        )
-
-        subquery = sa.select(
-            SaSkymapTile.probdensity,
-            cum_prob
-        ).filter(
-            SaSkymapTile.localization_id == eventsequence.localization.id
-        ).subquery()
-
-        min_probdensity = sa.select(
-            sa.func.min(subquery.columns.probdensity)
-        ).filter(
-            subquery.columns.cum_prob <= prob
-        ).scalar_subquery()
+        subquery = cumulative_probability_subquery(eventsequence.localization.id)
+        min_probdensity = min_probdensity_subquery(subquery, prob)
 
         query = sa.select(
             SaTargetExtra.target_id
@@ -138,7 +133,7 @@ def create_candidates_from_targets(eventsequence, prob=0.95, target_ids=None):
         new_candidates = []
         for result in results:
             ec, created = EventCandidate.objects.get_or_create(
-                target=Target.objects.get(id=result[0]),
+                target_id=result[0],
                 nonlocalizedevent=eventsequence.nonlocalizedevent,
             )
             if created:
@@ -200,15 +195,15 @@ def create_elliptical_localization(nonlocalizedevent, center, radius, conf_inv=0
                 if not is_new:
                     # This is added to protect against race conditions where the localization has already been added
                     return localization
-                for i, row in enumerate(skymap):
-                    # This is necessary to make sure we don't get an underflow error in postgres
-                    # when operating with the probdensity float field
-                    probdensity = row['PROBDENSITY'] if row['PROBDENSITY'] > sys.float_info.min else 0
-                    SkymapTile.objects.create(
-                        localization=localization,
-                        tile=uniq_to_bigintrange(row['UNIQ']),
-                        probdensity=probdensity,
-                    )
+                # This is necessary to make sure we don't get an underflow error in postgres
+                # when operating with the probdensity float field
+                probdensities = np.asarray(skymap['PROBDENSITY'], dtype=float)
+                probdensities = np.where(probdensities > sys.float_info.min, probdensities, 0.).tolist()
+                tiles = [
+                    SkymapTile(localization=localization, tile=uniq_to_bigintrange(uniq), probdensity=probdensity)
+                    for uniq, probdensity in zip(np.asarray(skymap['UNIQ']).tolist(), probdensities)
+                ]
+                SkymapTile.objects.bulk_create(tiles, batch_size=SKYMAP_TILE_BATCH_SIZE)  # multi-row INSERTs
             except IntegrityError as e:
                 if 'unique constraint' in e.message:
                     return EventLocalization.objects.get(nonlocalizedevent=nonlocalizedevent, skymap_hash=skymap_hash)
@@ -1,9 +1,13 @@
 import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from requests import Response
+from sqlalchemy import create_engine
+from kne_cand_vetting import catalogs, galaxy_matching, survey_phot
 from kne_cand_vetting.catalogs import static_cats_query
 from kne_cand_vetting.galaxy_matching import galaxy_search
 from kne_cand_vetting.survey_phot import TNS_get, query_ZTFpubphot
-from tom_targets.models import TargetExtra, TargetName
+from tom_targets.models import Target, TargetExtra, TargetName
 from tom_dataproducts.models import ReducedDatum
 import json
 import numpy as np
@@ -13,15 +17,80 @@ from astropy.coordinates import SkyCoord
 from astroquery.ipac.irsa.irsa_dust import IrsaDust
 from healpix_alchemy.constants import HPX
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 
 DB_CONNECT = "postgresql+psycopg2://{USER}:{PASSWORD}@{HOST}:{PORT}/{NAME}".format(**settings.DATABASES['default'])
 COSMOLOGY = FlatLambdaCDM(H0=70., Om0=0.3)
+ZTF_CACHE_TIMEOUT = 600  # seconds
+TARGET_BATCH_SIZE = 1000  # targets per UPDATE when saving the galactic coordinates of many targets
+QUERY_EXECUTOR = ThreadPoolExecutor(max_workers=4)  # shared by the vetting queries, which mostly wait on I/O
 
 logger = logging.getLogger(__name__)
 
 
+@functools.cache
+def get_catalog_engine(url, **kwargs):
+    """Create one pooled SQLAlchemy engine per database URL and reuse it for every catalog query"""
+    return create_engine(url, **{'pool_pre_ping': True, **kwargs})
+
+
+CATALOG_MODULES = (catalogs, galaxy_matching, survey_phot)
+
+
+def use_pooled_catalog_engines(modules=CATALOG_MODULES):
+    """
+    The vetting code takes a database URL and calls ``create_engine`` from its own module namespace on every query, which
+    would open a new engine (and connection) each time. Point that name at ``get_catalog_engine`` instead, and complain
+    loudly if a module no longer calls ``create_engine`` that way, since the patch would then do nothing.
+    """
+    for module in modules:
+        if getattr(module, 'create_engine', None) not in (create_engine, get_catalog_engine):
+            logger.error(f'{module.__name__} does not import sqlalchemy.create_engine; '
+                         'its catalog queries will not use the pooled engine')
+            continue
+        module.create_engine = get_catalog_engine
+
+
+use_pooled_catalog_engines()
+
+
+def jd_to_datetimes(jds):
+    """Convert a list of Julian dates to timezone-aware datetimes in a single call"""
+    if not len(jds):
+        return []
+    return Time(jds, format='jd', scale='utc').to_datetime(timezone=TimezoneInfo())
+
+
+def save_new_reduced_data(target, reduced_data):
+    """
+    Save the ``ReducedDatum`` objects that do not already exist for a given target (or earlier in the input list), using a
+    single query to find the existing ones. Returns the list of objects that were saved.
+    """
+    def _key(timestamp, source_name, data_type, value):
+        return timestamp, source_name, data_type, json.dumps(value, sort_keys=True)
+
+    existing = {_key(*row) for row in
+                target.reduceddatum_set.values_list('timestamp', 'source_name', 'data_type', 'value')}
+    new_reduced_data = []
+    for rd in reduced_data:
+        key = _key(rd.timestamp, rd.source_name, rd.data_type, rd.value)
+        if key not in existing:
+            existing.add(key)
+            new_reduced_data.append(rd)
+    # saved one at a time rather than with bulk_create so that ReducedDatum.save() and the post_save signals that the
+    # TOM Toolkit and its plugins rely on still run, but in one transaction
+    with transaction.atomic():
+        for rd in new_reduced_data:
+            rd.save()
+    return new_reduced_data
+
+
 def process_reduced_ztf_data(target, candidates):
     """Ingest data from the ZTF JSON format into ``ReducedDatum`` objects. Mostly copied from tom_base v2.13.0."""
+    values = []
+    jds = []
+    zids = []
     for candidate in candidates:
         if all([key in candidate['candidate'] for key in ['jd', 'magpsf', 'fid', 'sigmapsf']]):
             nondetection = False
@@ -29,8 +98,6 @@ def process_reduced_ztf_data(target, candidates):
             nondetection = True
         else:
             continue
-        jd = Time(candidate['candidate']['jd'], format='jd', scale='utc')
-        jd.to_datetime(timezone=TimezoneInfo())
         value = {
             'filter': {1: 'g', 2: 'r', 3: 'i'}[candidate['candidate']['fid']]
         }
@@ -39,15 +106,14 @@ def process_reduced_ztf_data(target, candidates):
         else:
             value['magnitude'] = candidate['candidate']['magpsf']
             value['error'] = candidate['candidate']['sigmapsf']
-        rd, created = ReducedDatum.objects.get_or_create(
-            timestamp=jd.to_datetime(timezone=TimezoneInfo()),
-            value=value,
-            source_name='ZTF',
-            data_type='photometry',
-            target=target)
-        if created:  # do this afterward, in case there are duplicate candidates with distinct ZIDs
-            rd.source_location = candidate['zid']
-            rd.save()
+        values.append(value)
+        jds.append(candidate['candidate']['jd'])
+        zids.append(candidate['zid'])
+    # in case there are duplicate candidates with distinct ZIDs, only the first one is saved
+    reduced_data = [ReducedDatum(timestamp=timestamp, value=value, source_name='ZTF', source_location=zid,
+                                 data_type='photometry', target=target)
+                    for timestamp, value, zid in zip(jd_to_datetimes(jds), values, zids)]
+    save_new_reduced_data(target, reduced_data)
 
 
 def update_or_create_target_extra(target, key, value):
@@ -55,9 +121,92 @@ def update_or_create_target_extra(target, key, value):
     Check if a ``TargetExtra`` with the given key exists for a given target. If it exists, update the value. If it does
     not exist, create it with the input value.
     """
-    te, created = TargetExtra.objects.get_or_create(target=target, key=key)
-    te.value = value
-    te.save()
+    TargetExtra.objects.update_or_create(target=target, key=key, defaults={'value': value})
+
+
+def save_static_catalog_matches(target, qso, qoffset, asassn, asassnoffset, gaia, gaiaoffset, gaiaclass, ps1prob, ps1,
+                                ps1offset):
+    """Store the results of the static catalog crossmatch for one target as ``TargetExtra`` objects"""
+    with transaction.atomic():  # commit all the matches at once
+        update_or_create_target_extra(target=target, key='QSO Match', value=qso)
+        if qso != 'None':
+            update_or_create_target_extra(target=target, key='QSO Offset', value=qoffset)
+
+        update_or_create_target_extra(target=target, key='ASASSN Match', value=asassn)
+        if asassn != 'None':
+            update_or_create_target_extra(target=target, key='ASASSN Offset', value=asassnoffset)
+
+        update_or_create_target_extra(target=target, key='Gaia Match', value=gaia)
+        if gaia != 'None':
+            update_or_create_target_extra(target=target, key='Gaia VS Offset', value=gaiaoffset)
+            update_or_create_target_extra(target=target, key='Gaia VS Class', value=gaiaclass)
+
+        update_or_create_target_extra(target=target, key='PS1 match', value=ps1)
+        if ps1 != 'None' and ps1 != 'Multiple matches' and ps1 != 'Galaxy match':
+            update_or_create_target_extra(target=target, key='PS1 Star Prob.', value=ps1prob)
+            update_or_create_target_extra(target=target, key='PS1 Offset', value=ps1offset)
+
+
+def set_galactic_coordinates(targets):
+    """
+    Calculate the galactic coordinates of several targets with a single (vectorized) coordinate transformation and save
+    them, without calling ``Target.save`` (or the post-save hook) for each target.
+    """
+    targets = list(targets)
+    if not targets:
+        return
+    galactic = SkyCoord([target.ra for target in targets], [target.dec for target in targets], unit='deg').galactic
+    for target, lng, lat in zip(targets, galactic.l.deg, galactic.b.deg):
+        target.galactic_lng = lng
+        target.galactic_lat = lat
+    Target.objects.bulk_update(targets, ['galactic_lng', 'galactic_lat'], batch_size=TARGET_BATCH_SIZE)
+
+
+def static_catalog_vetting(targets):
+    """
+    Crossmatch several targets with the static catalogs (QSOs, ASAS-SN, Gaia, and PS1) in a single query and store the
+    results. The TNS and host galaxy steps of the vetting are run one target at a time by ``target_post_save``.
+    """
+    targets = list(targets)
+    if not targets:
+        return
+    qso, qoffset, asassn, asassnoffset, _, gaia, gaiaoffset, gaiaclass, ps1prob, ps1, ps1offset = \
+        static_cats_query([target.ra for target in targets], [target.dec for target in targets], db_connect=DB_CONNECT)
+    with transaction.atomic():
+        for i, target in enumerate(targets):
+            save_static_catalog_matches(target, qso[i], qoffset[i], asassn[i], asassnoffset[i], gaia[i], gaiaoffset[i],
+                                        gaiaclass[i], ps1prob[i], ps1[i], ps1offset[i])
+    logger.info(f'Crossmatched {len(targets):d} targets with the static catalogs')
+
+
+def query_tns_object(objname, tns_time_limit=5):
+    """
+    Get the details and photometry of a transient from the TNS API by name (without prefix). Returns the reply (or None)
+    and a status message if the query failed (or None). The reply is never cached: it is meant to be more recent than
+    the local copy of the TNS, and a cached reply could undo a rename or reclassification made by ``ingest_tns``.
+    """
+    get_obj = [("objname", objname), ("objid", ""), ("photometry", "1"), ("spectra", "0")]
+    response, time_to_wait = TNS_get(get_obj,
+                                     settings.BROKERS['TNS']['bot_id'],
+                                     settings.BROKERS['TNS']['bot_name'],
+                                     settings.BROKERS['TNS']['api_key'],
+                                     timelimit=tns_time_limit)
+    if response is not None and response.status_code == 200:
+        return response.json()['data'], None
+
+    if isinstance(response, Response):
+        tns_query_status = f"TNS Request responded with code {response.status_code}!\n{response}"
+    else:
+        tns_query_status = f'We ran out of API calls to the TNS with {time_to_wait}s left! This exceeded the {tns_time_limit}s limit!'
+    logger.info(tns_query_status)
+    return None, tns_query_status
+
+
+def query_ztf_photometry(ra, dec):
+    """Get public ZTF photometry around a position, caching the result for a few minutes"""
+    return cache.get_or_set(f'ztfphot:{ra:.6f}:{dec:.6f}',
+                            lambda: query_ZTFpubphot(ra, dec, db_connect=DB_CONNECT),
+                            ZTF_CACHE_TIMEOUT)
 
 
 def target_post_save(target, created, tns_time_limit:int=5):
@@ -68,13 +217,18 @@ def target_post_save(target, created, tns_time_limit:int=5):
     tns_query_status = None
     if created:
         coord = SkyCoord(target.ra, target.dec, unit='deg')
-        target.galactic_lng = coord.galactic.l.deg
-        target.galactic_lat = coord.galactic.b.deg
-        target.save()
+        set_galactic_coordinates([target])  # always, since ra/dec may have been edited since they were stored
 
-        if target.extra_fields.get('MW E(B-V)') is None:
+        # the catalog and dust queries are I/O bound and independent, so run them in the background
+        extra_fields = target.extra_fields  # fetch the typed extras once instead of once per lookup
+        dust_future = None
+        if extra_fields.get('MW E(B-V)') is None:
+            dust_future = QUERY_EXECUTOR.submit(IrsaDust.get_query_table, coord, section='ebv')
+        static_future = QUERY_EXECUTOR.submit(static_cats_query, [target.ra], [target.dec], db_connect=DB_CONNECT)
+
+        if dust_future is not None:
             try:
-                mwebv = IrsaDust.get_query_table(coord, section='ebv')['ext SandF ref'][0]
+                mwebv = dust_future.result()['ext SandF ref'][0]
             except Exception as e:
                 logger.error(f'Error querying IRSA dust for {target.name}')
             else:
@@ -85,7 +239,7 @@ def target_post_save(target, created, tns_time_limit:int=5):
         update_or_create_target_extra(target=target, key='healpix', value=HPX.skycoord_to_healpix(coord))
 
         qso, qoffset, asassn, asassnoffset, tns_results, gaia, gaiaoffset, gaiaclass, ps1prob, ps1, ps1offset = \
-            static_cats_query([target.ra], [target.dec], db_connect=DB_CONNECT)
+            static_future.result()
 
         if tns_results:
             for iau_name, redshift, classification, internal_names in tns_results:
@@ -93,96 +247,72 @@ def target_post_save(target, created, tns_time_limit:int=5):
                     break
 
             # now query the real TNS by name for even more recent updates
-            get_obj = [("objname", iau_name[2:]), ("objid", ""), ("photometry", "1"), ("spectra", "0")]  # remove prefix
-            response, time_to_wait = TNS_get(get_obj,
-                                             settings.BROKERS['TNS']['bot_id'],
-                                             settings.BROKERS['TNS']['bot_name'],
-                                             settings.BROKERS['TNS']['api_key'],
-                                             timelimit=tns_time_limit)
-            if response is not None and response.status_code == 200:
-                tns_reply = response.json()['data']
-
-                # update the coordinates if needed
-                radeg = float(tns_reply['radeg'])
-                decdeg = float(tns_reply['decdeg'])
-                if target.ra != radeg or target.dec != decdeg:
-                    target.ra = radeg
-                    target.dec = decdeg
-                    target.save()
-                    messages.append(f'Updated coordinates to {target.ra:.6f}, {target.dec:.6f} based on TNS')
-
-                # ingest any photometry
-                n_new_phot = 0
-                for candidate in tns_reply['photometry']:
-                    jd = Time(candidate['jd'], format='jd', scale='utc')
-                    value = {'filter': candidate['filters']['name']}
-                    if candidate['flux']:  # detection
-                        value['magnitude'] = float(candidate['flux'])
-                    else:
-                        value['limit'] = float(candidate['limflux'])
-                    if candidate['fluxerr']:  # not empty or zero
-                        value['error'] = float(candidate['fluxerr'])
-                    rd, created = ReducedDatum.objects.get_or_create(
-                        timestamp=jd.to_datetime(timezone=TimezoneInfo()),
-                        value=value,
-                        source_name=candidate['telescope']['name'] + ' (TNS)',
-                        data_type='photometry',
-                        target=target)
-                    n_new_phot += created
-                if n_new_phot:
-                    messages.append(f'Added {n_new_phot:d} photometry points from the TNS')
-
-                # if query is successful, use these up-to-date versions instead of what's in the local copy
-                iau_name = tns_reply['name_prefix'] + tns_reply['objname']
-                if tns_reply['redshift']:
-                    redshift = float(tns_reply['redshift'])
-                classification = tns_reply['object_type']['name']
-                internal_names = tns_reply['internal_names']
+            tns_reply, tns_query_status = query_tns_object(iau_name[2:], tns_time_limit)  # remove prefix
+            with transaction.atomic():  # write the TNS results in one transaction
+                if tns_reply is not None:
+                    # update the coordinates if needed
+                    radeg = float(tns_reply['radeg'])
+                    decdeg = float(tns_reply['decdeg'])
+                    if target.ra != radeg or target.dec != decdeg:
+                        target.ra = radeg
+                        target.dec = decdeg
+                        target.save()
+                        set_galactic_coordinates([target])
+                        messages.append(f'Updated coordinates to {target.ra:.6f}, {target.dec:.6f} based on TNS')
 
-            else:
-                if isinstance(response, Response):
-                    tns_query_status = f"TNS Request responded with code {response.status_code}!\n{response}"
-                else:
-                    tns_query_status = f'We ran out of API calls to the TNS with {time_to_wait}s left! This exceeded the {tns_time_limit}s limit!'
-                    
-                logger.info(tns_query_status)
-
-            # update the target details from the TNS query, if successful, or from the local copy in the database
-            if target.name != iau_name:
-                target.name = iau_name
-                target.save()
-                messages.append(f"Found a match in the TNS: {target.name}")
-            if classification and target.extra_fields.get('Classification') != classification:
-                update_or_create_target_extra(target, 'Classification', classification)
-                messages.append(f"Classification set to {classification}")
-            if redshift is not None and np.isfinite(redshift) and target.extra_fields.get('Redshift') != redshift:
-                update_or_create_target_extra(target, 'Redshift', redshift)
-                messages.append(f"Redshift set to {redshift}")
-            for internal_name in internal_names.split(','):
-                alias = internal_name.strip().replace('SN ', 'SN').replace('AT ', 'AT')
-                if alias and alias != target.name and not TargetName.objects.filter(name=alias).exists():
-                    tn = TargetName.objects.create(target=target, name=alias)
-                    messages.append(f'Added alias {tn.name} from TNS')
-                
-        update_or_create_target_extra(target=target, key='QSO Match', value=qso[0])
-        if qso[0] != 'None':
-            update_or_create_target_extra(target=target, key='QSO Offset', value=qoffset[0])
+                    # ingest any photometry
+                    timestamps = jd_to_datetimes([candidate['jd'] for candidate in tns_reply['photometry']])
+                    reduced_data = []
+                    for candidate, timestamp in zip(tns_reply['photometry'], timestamps):
+                        value = {'filter': candidate['filters']['name']}
+                        if candidate['flux']:  # detection
+                            value['magnitude'] = float(candidate['flux'])
+                        else:
+                            value['limit'] = float(candidate['limflux'])
+                        if candidate['fluxerr']:  # not empty or zero
+                            value['error'] = float(candidate['fluxerr'])
+                        reduced_data.append(ReducedDatum(
+                            timestamp=timestamp,
+                            value=value,
+                            source_name=candidate['telescope']['name'] + ' (TNS)',
+                            data_type='photometry',
+                            target=target))
+                    n_new_phot = len(save_new_reduced_data(target, reduced_data))
+                    if n_new_phot:
+                        messages.append(f'Added {n_new_phot:d} photometry points from the TNS')
 
-        update_or_create_target_extra(target=target, key='ASASSN Match', value=asassn[0])
-        if asassn[0] != 'None':
-            update_or_create_target_extra(target=target, key='ASASSN Offset', value=asassnoffset[0])
+                    # if query is successful, use these up-to-date versions instead of what's in the local copy
+                    iau_name = tns_reply['name_prefix'] + tns_reply['objname']
+                    if tns_reply['redshift']:
+                        redshift = float(tns_reply['redshift'])
+                    classification = tns_reply['object_type']['name']
+                    internal_names = tns_reply['internal_names']
 
-        update_or_create_target_extra(target=target, key='Gaia Match', value=gaia[0])
-        if gaia[0] != 'None':
-            update_or_create_target_extra(target=target, key='Gaia VS Offset', value=gaiaoffset[0])
-            update_or_create_target_extra(target=target, key='Gaia VS Class', value=gaiaclass[0])
+                # update the target details from the TNS query, if successful, or from the local copy in the database
+                if target.name != iau_name:
+                    target.name = iau_name
+                    target.save(update_fields=['name', 'modified'])
+                    messages.append(f"Found a match in the TNS: {target.name}")
+                if classification and extra_fields.get('Classification') != classification:
+                    update_or_create_target_extra(target, 'Classification', classification)
+                    messages.append(f"Classification set to {classification}")
+                if redshift is not None and np.isfinite(redshift) and extra_fields.get('Redshift') != redshift:
+                    update_or_create_target_extra(target, 'Redshift', redshift)
+                    messages.append(f"Redshift set to {redshift}")
+                for internal_name in internal_names.split(','):
+                    alias = internal_name.strip().replace('SN ', 'SN').replace('AT ', 'AT')
+                    if alias and alias != target.name and not TargetName.objects.filter(name=alias).exists():
+                        tn = TargetName.objects.create(target=target, name=alias)
+                        messages.append(f'Added alias {tn.name} from TNS')
+                
+        save_static_catalog_matches(target, qso[0], qoffset[0], asassn[0], asassnoffset[0], gaia[0], gaiaoffset[0],
+                                    gaiaclass[0], ps1prob[0], ps1[0], ps1offset[0])
 
-        update_or_create_target_extra(target=target, key='PS1 match', value=ps1[0])
-        if ps1[0] != 'None' and ps1[0] != 'Multiple matches' and ps1[0] != 'Galaxy match':
-            update_or_create_target_extra(target=target, key='PS1 Star Prob.', value=ps1prob[0])
-            update_or_create_target_extra(target=target, key='PS1 Offset', value=ps1offset[0])
+        # the TNS may have updated the coordinates, so only now start the position-dependent queries
+        host_future = QUERY_EXECUTOR.submit(galaxy_search, target.ra, target.dec, db_connect=DB_CONNECT)
+        ztf_future = QUERY_EXECUTOR.submit(query_ztf_photometry, target.ra, target.dec)
 
-        matches, hostdict = galaxy_search(target.ra, target.dec, db_connect=DB_CONNECT)
+        matches, hostdict = host_future.result()
         update_or_create_target_extra(target=target, key='Host Galaxies', value=json.dumps(hostdict))
 
         if hostdict and target.distance is None:
@@ -194,25 +324,25 @@ def target_post_save(target, created, tns_time_limit:int=5):
                 target.distance_err = np.mean(disterr)
             target.save()
 
-        ztfphot = query_ZTFpubphot(target.ra, target.dec, db_connect=DB_CONNECT)
-        newztfphot = []
-        if ztfphot:
-            olddatetimes = [rd.timestamp for rd in target.reduceddatum_set.all()]
-            for candidate in ztfphot:
-                jd = Time(candidate['candidate']['jd'], format='jd', scale='utc')
-                newdatetime = jd.to_datetime(timezone=TimezoneInfo())
-                if newdatetime not in olddatetimes:
-                    logger.info('New ZTF point at {0}.'.format(newdatetime))
-                    newztfphot.append(candidate)
-                if not TargetName.objects.filter(name=candidate['oid']).exists():
-                    tn = TargetName.objects.create(target=target, name=candidate['oid'])
-                    messages.append(f'Added alias {tn.name} from ZTF')
-        process_reduced_ztf_data(target, newztfphot)
-
-    redshift = target.targetextra_set.filter(key='Redshift')
-    if redshift.exists() and redshift.first().float_value >= 0.02 and target.distance is None:
+        ztfphot = ztf_future.result()
+        with transaction.atomic():
+            newztfphot = []
+            if ztfphot:
+                olddatetimes = set(target.reduceddatum_set.values_list('timestamp', flat=True))
+                newdatetimes = jd_to_datetimes([candidate['candidate']['jd'] for candidate in ztfphot])
+                for candidate, newdatetime in zip(ztfphot, newdatetimes):
+                    if newdatetime not in olddatetimes:
+                        logger.info('New ZTF point at {0}.'.format(newdatetime))
+                        newztfphot.append(candidate)
+                    if not TargetName.objects.filter(name=candidate['oid']).exists():
+                        tn = TargetName.objects.create(target=target, name=candidate['oid'])
+                        messages.append(f'Added alias {tn.name} from ZTF')
+            process_reduced_ztf_data(target, newztfphot)
+
+    redshift = target.targetextra_set.filter(key='Redshift').values_list('float_value', flat=True).first()
+    if redshift is not None and redshift >= 0.02 and target.distance is None:
         messages.append(f'Updating distance of {target.name} based on redshift')
-        target.distance = COSMOLOGY.luminosity_distance(redshift.first().float_value).to('Mpc').value
+        target.distance = COSMOLOGY.luminosity_distance(redshift).to('Mpc').value
         target.save()
 
     for message in messages:
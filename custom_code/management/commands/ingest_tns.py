@@ -1,17 +1,19 @@
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from django.db import connection
-from tom_targets.models import Target
+from django.db.models import Min, Q
+from tom_targets.models import Target, TargetExtra
+from tom_dataproducts.models import ReducedDatum
 from tom_dataproducts.tasks import atlas_query
 from custom_code.hooks import target_post_save
 from custom_code.tasks import target_run_mpc
 from custom_code.healpix_utils import create_candidates_from_targets
-from custom_code.alertstream_handlers import pick_slack_channel, send_slack
+from custom_code.alertstream_handlers import pick_slack_channel, send_slack, post_to_slack
 from custom_code.templatetags.skymap_extras import get_preferred_localization
 from tom_treasuremap.management.commands.report_pointings import get_active_nonlocalizedevents
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from astropy.time import Time
-import requests
 import json
 import logging
 import traceback
@@ -20,6 +22,12 @@ import numpy as np
 
 logger = logging.getLogger(__name__)
 
+DISTANCE_CATALOGS = frozenset(['GLADE', 'GWGC', 'HECATE'])  # host galaxy catalogs that have distances
+CANDIDATE_ALERT = ('<{target_link}|{{target.name}}> falls in the {{credible_region:d}}% '
+                   'localization region of <{nle_link}|{{nle.event_id}}>')
+# Einstein Probe alerts only go to the first workspace, so fill in its links once rather than for every candidate
+CANDIDATE_ALERT_EP = CANDIDATE_ALERT.format(nle_link=settings.NLE_LINKS[0][0], target_link=settings.TARGET_LINKS[0][0])
+
 
 def vet_or_post_error(target):
     try:
@@ -28,19 +36,26 @@ def vet_or_post_error(target):
         _, tns_query_status = target_post_save(target, created=True, tns_time_limit=np.inf)
         if tns_query_status is not None:
             logger.warn(tns_query_status)
-            json_data = json.dumps({'text': tns_query_status}).encode('ascii')
-            requests.post(settings.SLACK_TNS_URL, data=json_data, headers={'Content-Type': 'application/json'})
+            post_to_slack(settings.SLACK_TNS_URL, tns_query_status)
         detections = target.reduceddatum_set.filter(data_type="photometry", value__magnitude__isnull=False)
-        if detections.exists():
-            target_run_mpc.send(detections.latest().id)
+        latest_id = detections.order_by('-timestamp').values_list('id', flat=True).first()
+        if latest_id is not None:
+            target_run_mpc.send(latest_id)
         mjd_now = Time.now().mjd
         atlas_query.send(mjd_now - 20., mjd_now, target.id, 'atlas_photometry')
                          
     except Exception as e:
         slack_alert = f'Error vetting TNS target {target.name}:\n{e}'
         logger.error(''.join(traceback.format_exception(e)))
-        json_data = json.dumps({'text': slack_alert}).encode('ascii')
-        requests.post(settings.SLACK_TNS_URL, data=json_data, headers={'Content-Type': 'application/json'})
+        post_to_slack(settings.SLACK_TNS_URL, slack_alert)
+
+
+def vet_in_thread(target):
+    try:
+        vet_or_post_error(target)
+    finally:
+        connection.close()  # each worker thread opens its own database connection
+
         
 class Command(BaseCommand):
 
@@ -52,8 +67,11 @@ class Command(BaseCommand):
         parser.add_argument('--lookback-days-obs', help='Associate transients whose first detection was within this '
                                                         'many days of the nonlocalized event',
                             type=float, default=3.)
+        parser.add_argument('--threads', type=int, default=1,
+                            help='Vet this many new or updated targets at a time. Each one makes its own TNS API '
+                                 'request, so keep this low enough to stay within the TNS rate limit for your bot.')
 
-    def handle(self, lookback_days_nle=7., lookback_days_obs=3., **kwargs):
+    def handle(self, lookback_days_nle=7., lookback_days_obs=3., threads=1, **kwargs):
         
         updated_targets_coords = Target.objects.raw(
             """
@@ -194,28 +212,48 @@ class Command(BaseCommand):
 
         new_or_updated_targets = [updated_targets_coords, updated_targets, new_targets]
 
-        for targets in new_or_updated_targets:
-            for target in targets:
-                vet_or_post_error(target)
+        # vetting is mostly waiting on the TNS and catalog queries, so several targets can be vetted at once
+        # (a target can be returned by more than one step, but it only needs to be vetted once). Each thread sends at
+        # most one TNS API request at a time; the catalog and dust queries go through the separate, fixed-size
+        # hooks.QUERY_EXECUTOR, which is shared by all threads and so does not multiply with --threads.
+        targets_to_vet = {target.id: target for targets in new_or_updated_targets for target in targets}
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = {executor.submit(vet_in_thread, target): target for target in targets_to_vet.values()}
+        for future, target in futures.items():  # every call has finished once the executor has shut down
+            if future.exception() is not None:  # anything that escaped vet_or_post_error, e.g., posting to Slack
+                logger.error(f'Error vetting TNS target {target.name}: '
+                             + ''.join(traceback.format_exception(future.exception())))
 
+        # fetch the host galaxies of all the new targets at once, letting the database drop any target
+        # that has no host from a catalog with distances before the JSON is sent over and parsed
+        has_distance_catalog = Q()
+        for catalog in DISTANCE_CATALOGS:
+            has_distance_catalog |= Q(value__contains=f'"{catalog}"')
+        host_galaxies = dict(TargetExtra.objects.filter(has_distance_catalog, key='Host Galaxies',
+                                                        target_id__in=[target.id for target in new_targets])
+                             .values_list('target_id', 'value'))
         for target in new_targets:
             # check if any of the possible host galaxies are within 40 Mpc
-            target_extra = target.targetextra_set.filter(key='Host Galaxies').first()
-            if target_extra is None:
+            if target.id not in host_galaxies:
                 continue
-            for galaxy in json.loads(target_extra.value):
-                if galaxy['Source'] in ['GLADE', 'GWGC', 'HECATE'] and galaxy['Dist'] <= 40.:  # catalogs that have dist
-                    slack_alert = (f'<{settings.TARGET_LINKS[0][0]}|{target.name}> is {galaxy["Offset"]:.1f}" from '
-                                   f'galaxy {galaxy["ID"]} at {galaxy["Dist"]:.1f} Mpc.').format(target=target)
+            for galaxy in json.loads(host_galaxies[target.id]):
+                if galaxy['Source'] in DISTANCE_CATALOGS and galaxy['Dist'] <= 40.:
+                    # only the link is a template, so the galaxy ID never passes through str.format
+                    target_link = settings.TARGET_LINKS[0][0].format(target=target)
+                    slack_alert = (f'<{target_link}|{target.name}> is {galaxy["Offset"]:.1f}" from '
+                                   f'galaxy {galaxy["ID"]} at {galaxy["Dist"]:.1f} Mpc.')
                     break
             else:
                 continue
 
-            # if there was nearby host galaxy found, check the last nondetection
-            photometry = target.reduceddatum_set.filter(data_type='photometry')
-            first_det = photometry.filter(value__magnitude__isnull=False).order_by('timestamp').first()
-            last_nondet = photometry.filter(value__magnitude__isnull=True,
-                                            timestamp__lt=first_det.timestamp).order_by('timestamp').last()
+            # if there was nearby host galaxy found, check the last nondetection (in one pass through the photometry)
+            first_det = last_nondet = None
+            photometry = target.reduceddatum_set.only('timestamp', 'value').filter(data_type='photometry')
+            for datum in photometry.order_by('timestamp'):
+                if 'magnitude' in datum.value:
+                    first_det = datum
+                    break
+                last_nondet = datum
             if first_det and last_nondet:
                 time_lnondet = (first_det.timestamp - last_nondet.timestamp).total_seconds() / 3600.
                 dmag_lnondet = (last_nondet.value['limit'] - first_det.value['magnitude']) / (time_lnondet / 24.)
@@ -224,31 +262,28 @@ class Command(BaseCommand):
             else:
                 slack_alert += ' No nondetection was reported.'
 
-            json_data = json.dumps({'text': slack_alert}).encode('ascii')
-            requests.post(settings.SLACK_TNS_URL, data=json_data, headers={'Content-Type': 'application/json'})
+            post_to_slack(settings.SLACK_TNS_URL, slack_alert)
 
         # automatically associate with nonlocalized events
-        for nle in get_active_nonlocalizedevents(lookback_days=lookback_days_nle):
+        # (look up every target's first detection in one query, and only if there are any active events)
+        active_nles = list(get_active_nonlocalizedevents(lookback_days=lookback_days_nle))
+        if active_nles:
+            detections = ReducedDatum.objects.filter(target_id__in=targets_to_vet.keys(), data_type='photometry',
+                                                     value__magnitude__isnull=False)
+            first_det_times = dict(detections.values_list('target_id').annotate(Min('timestamp')))
+        for nle in active_nles:
             seq = nle.sequences.last()
             localization = get_preferred_localization(nle)
             nle_time = datetime.strptime(seq.details['time'], '%Y-%m-%dT%H:%M:%S.%f%z')
-            target_ids = []
-            for targets in new_or_updated_targets:
-                for target in targets:
-                    first_det = target.reduceddatum_set.filter(data_type='photometry',
-                                                               value__magnitude__isnull=False).earliest()
-                    if nle_time < first_det.timestamp < nle_time + timedelta(days=lookback_days_obs):
-                        target_ids.append(target.id)
+            target_ids = [target_id for target_id, first_det_time in first_det_times.items()
+                          if nle_time < first_det_time < nle_time + timedelta(days=lookback_days_obs)]
             candidates = create_candidates_from_targets(seq, target_ids=target_ids)
+            is_gw = nle.event_type == nle.NonLocalizedEventType.GRAVITATIONAL_WAVE
+            slack_channel = pick_slack_channel(seq) if is_gw and candidates else None  # same for every candidate
             for candidate in candidates:
                 credible_region = candidate.credibleregions.get(localization=localization).smallest_percent
                 format_kwargs = {'nle': nle, 'target': candidate.target, 'credible_region': credible_region}
-                slack_alert = ('<{target_link}|{{target.name}}> falls in the {{credible_region:d}}% '
-                               'localization region of <{nle_link}|{{nle.event_id}}>')
-                if nle.event_type == nle.NonLocalizedEventType.GRAVITATIONAL_WAVE:
-                    send_slack(slack_alert, format_kwargs, *pick_slack_channel(seq))
+                if is_gw:
+                    send_slack(CANDIDATE_ALERT, format_kwargs, *slack_channel)
                 elif nle.event_type == nle.NonLocalizedEventType.UNKNOWN:
-                    body = slack_alert.format(nle_link=settings.NLE_LINKS[0][0],
-                                              target_link=settings.TARGET_LINKS[0][0])
-                    json_data = json.dumps({'text': body.format(**format_kwargs)}).encode('ascii')
-                    requests.post(settings.SLACK_EP_URL, data=json_data, headers={'Content-Type': 'application/json'})
+                    post_to_slack(settings.SLACK_EP_URL, CANDIDATE_ALERT_EP.format(**format_kwargs))
@@ -1,10 +1,10 @@
 from django.core.management.base import BaseCommand
 from tom_nonlocalizedevents.models import NonLocalizedEvent
 from django.conf import settings
-from datetime import datetime
+from custom_code.alertstream_handlers import post_to_slack
+from django.utils import timezone
 import requests
 import logging
-import json
 
 
 logger = logging.getLogger(__name__)
@@ -23,14 +23,11 @@ class Command(BaseCommand):
         nle = NonLocalizedEvent.objects.filter(event_id=latest_event)
         if nle.exists():
             es = nle.last().sequences.last()
-            now = datetime.now(es.created.tzinfo)
-            dt = (now - es.created).total_seconds()
+            dt = (timezone.now() - es.created).total_seconds()
             message = f'The last GW alert for {latest_event} was received {dt / 3600.:.1f} hours ago'
             logger.info(message)
         else:
             message = (f'The last GW alert for <https://gracedb.ligo.org/superevents/{latest_event}/|{latest_event}> '
                        f'was not received')
             logger.warning(message)
-            headers = {'Content-Type': 'application/json'}
-            data = json.dumps({'text': message}).encode('ascii')
-            requests.post(settings.SLACK_URLS[0][-1], data=data, headers=headers)
+            post_to_slack(settings.SLACK_URLS[0][-1], message)
@@ -0,0 +1,25 @@
+from django.db import migrations
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':  # the SQL below is PostgreSQL-specific
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS reduceddatum_target_ts_desc_idx '
+                              'ON tom_dataproducts_reduceddatum (target_id, timestamp DESC)')
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS reduceddatum_target_ts_desc_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tom_dataproducts", "0001_initial"),
+        ("custom_code", "0024_remove_surveyfieldcredibleregion_treasuremap_id_and_more"),
+    ]
+
+    # ReducedDatum belongs to tom_dataproducts, so index its table directly for "latest datum of this target" queries
+    operations = [
+        migrations.RunPython(create_index, reverse_code=drop_index),
+    ]
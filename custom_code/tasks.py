@@ -1,10 +1,13 @@
 import logging
 from kne_cand_vetting.mpc import minor_planet_match
 from tom_dataproducts.models import ReducedDatum
+from tom_targets.models import Target, TargetList
 from astropy.time import Time
+from django.core.cache import cache
 import dramatiq
 
-from .hooks import update_or_create_target_extra
+from .hooks import target_post_save, static_catalog_vetting, update_or_create_target_extra
+from .vetting_results import VETTING_RESULTS_TIMEOUT, vetting_results_key
 
 logger = logging.getLogger(__name__)
 
@@ -24,3 +27,27 @@ def target_run_mpc(latest_det_id, _verbose=False):
         update_or_create_target_extra(latest_det.target, 'Minor Planet Match', 'None')
         update_or_create_target_extra(latest_det.target, 'Minor Planet Date', latest_det.timestamp)
         logger.info(f"{latest_det.target.name} is not a minor planet!")
+
+
+# vetting reruns every TNS and catalog query, so a failure is reported to the user instead of retried
+@dramatiq.actor(max_retries=0)
+def target_run_vetting(target_id):
+    """run the kilonova candidate vetting code on a given target and store the results"""
+    target = Target.objects.get(id=target_id)
+    cache.set(vetting_results_key(target_id), {'status': 'running'}, VETTING_RESULTS_TIMEOUT)
+    try:
+        messages, tns_query_status = target_post_save(target, created=True)
+    except Exception as e:
+        cache.set(vetting_results_key(target_id), {'status': 'failed', 'error': str(e)}, VETTING_RESULTS_TIMEOUT)
+        raise
+    if tns_query_status is not None:
+        logger.warning(tns_query_status)
+    results = {'status': 'finished', 'messages': messages, 'tns_query_status': tns_query_status}
+    cache.set(vetting_results_key(target_id), results, VETTING_RESULTS_TIMEOUT)
+
+
+@dramatiq.actor(max_retries=0)
+def target_list_run_vetting(target_list_id):
+    """crossmatch all targets in a given target group with the static catalogs at once"""
+    target_list = TargetList.objects.get(id=target_list_id)
+    static_catalog_vetting(target_list.targets.all())
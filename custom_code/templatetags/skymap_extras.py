@@ -3,6 +3,8 @@ from tom_nonlocalizedevents.models import NonLocalizedEvent
 from astropy.coordinates import get_body
 from astropy.time import Time
 from datetime import timedelta
+from itertools import groupby
+from operator import itemgetter
 from astroplan import moon_illumination
 import numpy as np
 
@@ -43,18 +45,13 @@ def skymap(context, localization, survey_candidates=None, survey_observations=No
     }
 
     # potential survey fields
-    fields = localization.surveyfieldcredibleregions.filter(group__isnull=False)
-    if fields.exists():
-        groups = list(fields.order_by('group').values_list('group', flat=True).distinct())
-        vertices = []
-        for g in groups:
-            centers = np.array(fields.filter(group=g).values_list('survey_field__ra', 'survey_field__dec'))
-            cos_dec = np.cos(np.deg2rad(centers[:, ::-1]))
-            cos_dec[:, 1] = 1.  # take cosine of dec and divide the RAs by it
-            vertices.append((centers[:, np.newaxis] + CSS_FOOTPRINT / cos_dec[:, np.newaxis]).tolist())
-        extras['survey_fields'] = vertices
-    else:
-        extras['survey_fields'] = []
+    # (fetch every grouped field in one query and split them into groups here)
+    fields = (localization.surveyfieldcredibleregions.filter(group__isnull=False).order_by('group')
+              .values_list('group', 'survey_field__ra', 'survey_field__dec'))
+    extras['survey_fields'] = [
+        centers_to_vertices(np.array([(ra, dec) for _, ra, dec in rows]), CSS_FOOTPRINT)
+        for _, rows in groupby(fields, key=itemgetter(0))
+    ]
 
     # observed survey fields candidates
     if survey_observations is not None and survey_observations.exists():
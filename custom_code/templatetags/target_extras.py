@@ -1,10 +1,23 @@
 from django import template
+from django.core.cache import cache
 from astropy.coordinates import SkyCoord
+from custom_code.vetting_results import vetting_results_key
 import json
 
 register = template.Library()
 
 
+def get_host_galaxies(target):
+    """
+    Returns the list of possible host galaxies stored for a target, or None. The JSON is only fetched and parsed once
+    per target instance, because several template tags on the target page use it.
+    """
+    if not hasattr(target, '_host_galaxies'):
+        value = target.targetextra_set.filter(key='Host Galaxies').values_list('value', flat=True).first()
+        target._host_galaxies = json.loads(value) if value is not None else None
+    return target._host_galaxies
+
+
 @register.filter
 def ecliptic_lng(target):
     sc = SkyCoord(target.ra, target.dec, unit='deg')
@@ -23,9 +36,17 @@ def aladin_custom(target):
     Displays Aladin skyview of the given target along with basic finder chart annotations and circles around potential
     host galaxies. The resulting image is downloadable. This templatetag only works for sidereal targets.
     """
-    target_extra = target.targetextra_set.filter(key='Host Galaxies')
-    if target_extra.exists():
-        galaxies = json.loads(target_extra.first().value)
-    else:
-        galaxies = []
+    galaxies = get_host_galaxies(target) or []
     return {'target': target, 'galaxy_ras': [g['RA'] for g in galaxies], 'galaxy_decs': [g['Dec'] for g in galaxies]}
+
+
+@register.inclusion_tag('tom_targets/partials/vetting_results.html')
+def vetting_results(target):
+    """
+    Displays whether kilonova candidate vetting queued from the target page is waiting or running, or its results once it
+    has finished. Like messages, the results are only shown once.
+    """
+    results = cache.get(vetting_results_key(target.id))
+    if results is not None and results['status'] not in ('queued', 'running'):
+        cache.delete(vetting_results_key(target.id))
+    return {'results': results}
@@ -1,13 +1,11 @@
 from django import template
 from ..models import Candidate, TargetListExtra
-from tom_targets.models import TargetExtra
 from guardian.shortcuts import get_objects_for_user
 from tom_surveys.models import SurveyField, SurveyObservationRecord
 from .skymap_extras import CSS_FOOTPRINT, centers_to_vertices
+from .target_extras import get_host_galaxies
 import numpy as np
 from matplotlib.path import Path
-import json
-import numpy as np
 
 register = template.Library()
 
@@ -31,17 +29,13 @@ def galaxy_table(target):
     """
     Displays the most likely host galaxy matches.
     """
-    te = TargetExtra.objects.filter(target=target, key='Host Galaxies')
-    if te.exists():
-        galaxies = json.loads(te.first().value)
-    else:
-        galaxies = None
-    return {'galaxies': galaxies}
+    return {'galaxies': get_host_galaxies(target)}
 
 
 FIELDS = SurveyField.objects.order_by('name')
 CENTERS = np.array(FIELDS.values_list('ra', 'dec'))
 VERTICES = centers_to_vertices(CENTERS, CSS_FOOTPRINT)
+FIELD_PATHS = list(zip(FIELDS.values_list('name', flat=True), [Path(vertex) for vertex in VERTICES]))
 
 
 @register.filter
@@ -49,11 +43,7 @@ def get_survey_observations(target):
     """
     Get all survey observations that contain the coordinates of a given target
     """
-    matching_fields = []
-    for field, vertex in zip(FIELDS, VERTICES):
-        path = Path(vertex)
-        if path.contains_points([[target.ra, target.dec]])[0]:
-            matching_fields.append(field.name)
+    matching_fields = [name for name, path in FIELD_PATHS if path.contains_point((target.ra, target.dec))]
     return SurveyObservationRecord.objects.filter(survey_field__name__in=matching_fields)
 
 
@@ -1,3 +1,48 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
+from unittest import mock
+import inspect
+import numpy as np
+from .atlas import ClippedStackedAtlasProcessor
+from .hooks import CATALOG_MODULES, get_catalog_engine
 
-# Create your tests here.
+
+class PooledCatalogEngineTestCase(SimpleTestCase):
+    def test_vetting_modules_call_pooled_engine(self):
+        """The vetting code must look up the patched ``create_engine`` name from its module globals when it runs"""
+        for module in CATALOG_MODULES:
+            with self.subTest(module=module.__name__):
+                self.assertIs(module.create_engine, get_catalog_engine)
+                callers = [name for name, function in inspect.getmembers(module, inspect.isfunction)
+                           if function.__module__ == module.__name__
+                           and 'create_engine' in function.__code__.co_names]
+                self.assertTrue(callers, f'no function in {module.__name__} calls create_engine')
+
+    def test_engine_is_reused(self):
+        get_catalog_engine.cache_clear()
+        with mock.patch('custom_code.hooks.create_engine') as create_engine:
+            engines = {id(module.create_engine('postgresql://test')) for module in CATALOG_MODULES}
+        get_catalog_engine.cache_clear()
+        self.assertEqual(len(engines), 1)
+        create_engine.assert_called_once_with('postgresql://test', pool_pre_ping=True)
+
+
+class ClippedStackedAtlasProcessorTestCase(SimpleTestCase):
+    def process(self, data):
+        with mock.patch('builtins.open', mock.mock_open(read_data='')), \
+                mock.patch('custom_code.atlas.ATLAS_stack', return_value=data):
+            return ClippedStackedAtlasProcessor()._process_photometry_from_plaintext(mock.Mock())
+
+    def test_magnitudes_and_limits(self):
+        detection, nondetection, nan = self.process([
+            {'mjd': 60000., 'uJy': 100., 'duJy': 10., 'F': 'o'},
+            {'mjd': 60001., 'uJy': 10., 'duJy': 10., 'F': 'c'},
+            {'mjd': 60002., 'uJy': np.nan, 'duJy': 10., 'F': 'o'},
+        ])
+        self.assertAlmostEqual(detection['magnitude'], 23.9 - 2.5 * np.log10(100.))
+        self.assertAlmostEqual(detection['error'], 2.5 / np.log(10.) / 10.)
+        self.assertNotIn('limit', detection)
+        self.assertAlmostEqual(nondetection['limit'], 23.9 - 2.5 * np.log10(30.))
+        self.assertNotIn('magnitude', nondetection)
+        # a NaN S/N is reported as a magnitude, as it was before the conversion was vectorized
+        self.assertTrue(np.isnan(nan['magnitude']))
+        self.assertNotIn('limit', nan)
@@ -2,7 +2,7 @@ from django.urls import path
 
 from tom_targets.views import TargetGroupingView, TargetGroupingDeleteView
 from .views import TargetGroupingCreateView, CandidateListView, TargetReportView, TargetClassifyView, TargetVettingView, TargetMPCView
-from .views import ObservationCreateView, TargetNameSearchView, TargetListView
+from .views import ObservationCreateView, TargetNameSearchView, TargetListView, TargetGroupVettingView
 from .views import CSSFieldListView, GWListView, GRBListView, NeutrinoListView, UnknownListView
 from .views import CSSFieldExportView, CSSFieldSubmitView, EventCandidateCreateView, ProfileUpdateView
 from tom_nonlocalizedevents.views import SupereventIdView
@@ -17,6 +17,7 @@ urlpatterns = [
     path('targetgrouping/', TargetGroupingView.as_view(), name='targetgrouping'),
     path('targetgrouping/create/', TargetGroupingCreateView.as_view(), name='create-group'),
     path('targetgrouping/<int:pk>/delete/', TargetGroupingDeleteView.as_view(), name='delete-group'),
+    path('targetgrouping/<int:pk>/vet/', TargetGroupVettingView.as_view(), name='vet-group'),
     path('candidates/', CandidateListView.as_view(), name='candidates'),
     path('targets/<int:pk>/report/', TargetReportView.as_view(), name='report'),
     path('targets/<int:pk>/classify/', TargetClassifyView.as_view(), name='classify'),
@@ -0,0 +1,14 @@
+"""
+Cache keys for the status and results of vetting runs queued from the target page. This module has no dependencies, so
+the template tags can use it without importing the vetting code.
+"""
+
+VETTING_RESULTS_TIMEOUT = 86400  # seconds to keep the results of a vetting run until they are shown on the target page
+# seconds to show a queued vetting run: the task replaces this as soon as it starts, so if it has not by then, it is
+# not going to (e.g., no worker is running)
+VETTING_QUEUED_TIMEOUT = 600
+
+
+def vetting_results_key(target_id):
+    """Cache key for the status and results of the last vetting run queued from the target page"""
+    return f'vetting_results:{target_id}'
@@ -3,12 +3,16 @@ import logging
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Prefetch
 from django.urls import reverse_lazy
-from django.http import HttpResponseRedirect, StreamingHttpResponse
+from django.utils.functional import cached_property
+from django.http import HttpResponseBadRequest, HttpResponseRedirect, StreamingHttpResponse
 from django.views.generic.base import RedirectView
 from django.views.generic.edit import CreateView, TemplateResponseMixin, FormMixin, ProcessFormView, UpdateView
 from django_filters.views import FilterView
-from django.shortcuts import redirect
+from django.shortcuts import get_object_or_404, redirect
 from guardian.mixins import PermissionListMixin
 from guardian.shortcuts import get_objects_for_user
 
@@ -24,31 +28,47 @@ from .filters import CandidateFilter, CSSFieldCredibleRegionFilter, NonLocalized
 from .forms import TargetListExtraFormset, TargetReportForm, TargetClassifyForm, ProfileUpdateForm
 from .forms import NonLocalizedEventFormHelper, CandidateFormHelper
 from .forms import TNS_FILTER_CHOICES, TNS_INSTRUMENT_CHOICES, TNS_CLASSIFICATION_CHOICES
-from .hooks import target_post_save, update_or_create_target_extra
-from .tasks import target_run_mpc
+from .hooks import update_or_create_target_extra
+from .tasks import target_run_mpc, target_run_vetting, target_list_run_vetting
+from .vetting_results import VETTING_QUEUED_TIMEOUT, vetting_results_key
 from .templatetags.skymap_extras import get_preferred_localization
 
 import json
 import requests
+import threading
 import time
 from io import StringIO
+from itertools import groupby
+from operator import attrgetter
 
 import paramiko
 import os
 
-DB_CONNECT = "postgresql+psycopg2://{USER}:{PASSWORD}@{HOST}:{PORT}/{NAME}".format(**settings.DATABASES['default'])
-
 # from tom_catalogs.harvesters.tns import TNS_URL
 TNS_URL = 'https://sandbox.wis-tns.org/api'  # TODO: change this to the main site
 TNS = settings.BROKERS['TNS']  # includes the API credentials
 TNS_MARKER = 'tns_marker' + json.dumps({'tns_id': TNS['bot_id'], 'type': 'bot', 'name': TNS['bot_name']})
+TNS_HEADERS = {'User-Agent': TNS_MARKER}
 TNS_FILTER_IDS = {name: fid for fid, name in TNS_FILTER_CHOICES}
 TNS_INSTRUMENT_IDS = {name: iid for iid, name in TNS_INSTRUMENT_CHOICES}
 TNS_CLASSIFICATION_IDS = {name: cid for cid, name in TNS_CLASSIFICATION_CHOICES}
+TNS_FEEDBACK_HANDLERS = {  # feedback code: (function to get IAU name, message, message level)
+    '100': (lambda fb: 'AT' + fb['objname'], 'New transient {} was created', messages.SUCCESS),  # object inserted
+    '101': (lambda fb: fb['prefix'] + fb['objname'], 'Existing transient {} was reported', messages.INFO),  # exists
+    '121': (lambda fb: fb['new_object_name'], 'Transient name changed to {}', messages.SUCCESS),  # prefix changed
+}
+TNS_SESSIONS = threading.local()  # requests.Session is not thread-safe, so each server thread gets its own
 
 logger = logging.getLogger(__name__)
 
 
+def get_tns_session():
+    """Get the session for this thread, which reuses the connection to the TNS across requests"""
+    if not hasattr(TNS_SESSIONS, 'session'):
+        TNS_SESSIONS.session = requests.Session()
+    return TNS_SESSIONS.session
+
+
 class TargetGroupingCreateView(LoginRequiredMixin, CreateView):
     """
     View that handles the creation of ``TargetList`` objects, also known as target groups. Requires authentication.
@@ -119,7 +139,9 @@ class CandidateListView(FilterView):
         """
         return super().get_queryset().filter(
             target__in=get_objects_for_user(self.request.user, 'tom_targets.view_target')
-        )
+        ).select_related(
+            'target', 'observation_record__survey_field'
+        ).prefetch_related('target__eventcandidate_set__nonlocalizedevent')
 
 
 def upload_files_to_tns(files):
@@ -128,7 +150,7 @@ def upload_files_to_tns(files):
     https://sandbox.wis-tns.org/sites/default/files/api/TNS_bulk_reports_manual.pdf
     """
     json_data = {'api_key': TNS['api_key']}
-    response = requests.post(TNS_URL + '/set/file-upload', headers={'User-Agent': TNS_MARKER}, data=json_data, files=files)
+    response = get_tns_session().post(TNS_URL + '/set/file-upload', headers=TNS_HEADERS, data=json_data, files=files)
     response.raise_for_status()
     new_filenames = response.json()['data']
     logger.info(f"Uploaded {', '.join(new_filenames)} to the TNS")
@@ -141,7 +163,7 @@ def send_tns_report(data):
     https://sandbox.wis-tns.org/sites/default/files/api/TNS_bulk_reports_manual.pdf
     """
     json_data = {'api_key': TNS['api_key'], 'data': data}
-    response = requests.post(TNS_URL + '/set/bulk-report', headers={'User-Agent': TNS_MARKER}, data=json_data)
+    response = get_tns_session().post(TNS_URL + '/set/bulk-report', headers=TNS_HEADERS, data=json_data)
     response.raise_for_status()
     report_id = response.json()['data']['report_id']
     logger.info(f'Sent TNS report ID {report_id:d}')
@@ -156,11 +178,13 @@ def get_tns_report_reply(report_id, request):
     Posts an informational message in a banner on the page using ``request``
     """
     json_data = {'api_key': TNS['api_key'], 'report_id': report_id}
-    for _ in range(6):
-        time.sleep(5)
-        response = requests.post(TNS_URL + '/get/bulk-report-reply', headers={'User-Agent': TNS_MARKER}, data=json_data)
-        if response.ok:
+    delay = 0.5
+    for _ in range(8):  # back off exponentially, waiting up to ~30 s in total
+        time.sleep(delay)
+        response = get_tns_session().post(TNS_URL + '/get/bulk-report-reply', headers=TNS_HEADERS, data=json_data)
+        if response.ok and response.json().get('data', {}).get('feedback'):
             break
+        delay = min(delay * 2., 5.)
     response.raise_for_status()
     feedback_section = response.json()['data']['feedback']
     feedbacks = []
@@ -169,23 +193,13 @@ def get_tns_report_reply(report_id, request):
     if 'classification_report' in feedback_section:
         feedbacks += feedback_section['classification_report'][0]['classification_messages']
     for feedback in feedbacks:
-        if '100' in feedback:  # transient object was inserted
-            iau_name = 'AT' + feedback['100']['objname']
-            log_message = f'New transient {iau_name} was created'
-            logger.info(log_message)
-            messages.success(request, log_message)
-            break
-        elif '101' in feedback:  # transient object exists
-            iau_name = feedback['101']['prefix'] + feedback['101']['objname']
-            log_message = f'Existing transient {iau_name} was reported'
+        code = next((code for code in TNS_FEEDBACK_HANDLERS if code in feedback), None)
+        if code is not None:
+            get_iau_name, message_template, level = TNS_FEEDBACK_HANDLERS[code]
+            iau_name = get_iau_name(feedback[code])
+            log_message = message_template.format(iau_name)
             logger.info(log_message)
-            messages.info(request, log_message)
-            break
-        elif '121' in feedback:  # object name prefix has changed
-            iau_name = feedback['121']['new_object_name']
-            log_message = f'Transient name changed to {iau_name}'
-            logger.info(log_message)
-            messages.success(request, log_message)
+            messages.add_message(request, level, log_message)
             break
     else:  # this should never happen
         iau_name = None
@@ -202,21 +216,28 @@ class TargetReportView(PermissionListMixin, TemplateResponseMixin, FormMixin, Pr
     form_class = TargetReportForm
     template_name = 'tom_targets/targetreport_form.html'
 
+    @cached_property
+    def target(self):
+        """The target being reported, with its photometry prefetched from most to least recent"""
+        photometry = ReducedDatum.objects.filter(data_type='photometry').order_by('-timestamp')
+        return Target.objects.prefetch_related(
+            Prefetch('reduceddatum_set', queryset=photometry),
+        ).get(pk=self.kwargs['pk'])
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['target'] = Target.objects.get(pk=self.kwargs['pk'])
+        context['target'] = self.target
         return context
 
     def get_initial(self):
-        target = Target.objects.get(pk=self.kwargs['pk'])
+        target = self.target
         initial = {
             'ra': target.ra,
             'dec': target.dec,
             'reporter': f'{self.request.user.get_full_name()}, on behalf of SAGUARO',
         }
-        photometry = target.reduceddatum_set.filter(data_type='photometry')
-        if photometry.exists():
-            reduced_datum = photometry.latest()
+        reduced_datum = next(iter(target.reduceddatum_set.all()), None)  # already sorted by descending timestamp
+        if reduced_datum is not None:
             initial['observation_date'] = reduced_datum.timestamp
             initial['flux'] = reduced_datum.value.get('magnitude')
             initial['flux_error'] = reduced_datum.value.get('error')
@@ -234,9 +255,9 @@ class TargetReportView(PermissionListMixin, TemplateResponseMixin, FormMixin, Pr
 
         # update the target name
         if iau_name is not None:
-            target = Target.objects.get(pk=self.kwargs['pk'])
+            target = self.target
             target.name = iau_name
-            target.save()
+            target.save(update_fields=['name', 'modified'])
         return redirect(self.get_success_url())
 
     def get_success_url(self):
@@ -250,28 +271,34 @@ class TargetClassifyView(PermissionListMixin, TemplateResponseMixin, FormMixin,
     form_class = TargetClassifyForm
     template_name = 'tom_targets/targetclassify_form.html'
 
+    @cached_property
+    def target(self):
+        """The target being classified, with its extras and spectra (most recent first) prefetched"""
+        spectra = ReducedDatum.objects.filter(data_type='spectroscopy').select_related('data_product')
+        return Target.objects.prefetch_related(
+            Prefetch('reduceddatum_set', queryset=spectra.order_by('-timestamp')),
+            'targetextra_set',
+        ).get(pk=self.kwargs['pk'])
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['target'] = Target.objects.get(pk=self.kwargs['pk'])
+        context['target'] = self.target
         return context
 
     def get_initial(self):
-        target = Target.objects.get(pk=self.kwargs['pk'])
+        target = self.target
         initial = {
             'name': target.name.replace('AT', '').replace('SN', ''),
             'classifier': f'{self.request.user.get_full_name()}, on behalf of SAGUARO',
         }
-        classifications = target.targetextra_set.filter(key='Classification')
-        if classifications.exists():
-            classification = classifications.first().value
-            if classification in TNS_CLASSIFICATION_IDS:
-                initial['classification'] = (TNS_CLASSIFICATION_IDS[classification], classification)
-        redshift = target.targetextra_set.filter(key='Redshift')
-        if redshift.exists():
-            initial['redshift'] = redshift.first().value
-        spectra = target.reduceddatum_set.filter(data_type='spectroscopy')
-        if spectra.exists():
-            spectrum = spectra.latest()
+        extras = {te.key: te.value for te in target.targetextra_set.all()}
+        classification = extras.get('Classification')
+        if classification in TNS_CLASSIFICATION_IDS:
+            initial['classification'] = (TNS_CLASSIFICATION_IDS[classification], classification)
+        if 'Redshift' in extras:
+            initial['redshift'] = extras['Redshift']
+        spectrum = next(iter(target.reduceddatum_set.all()), None)  # already sorted by descending timestamp
+        if spectrum is not None:
             initial['observation_date'] = spectrum.timestamp
             initial['ascii_file'] = spectrum.data_product.data
         return initial
@@ -283,15 +310,16 @@ class TargetClassifyView(PermissionListMixin, TemplateResponseMixin, FormMixin,
 
         # update the target name
         if iau_name is not None:
-            target = Target.objects.get(pk=self.kwargs['pk'])
-            target.name = iau_name
-            target.save()
-
+            target = self.target
             classification = dict(TNS_CLASSIFICATION_CHOICES)[int(form.cleaned_data['classification'])]
-            update_or_create_target_extra(target, 'Classification', classification)
+            with transaction.atomic():
+                target.name = iau_name
+                target.save(update_fields=['name', 'modified'])
+                update_or_create_target_extra(target, 'Classification', classification)
+                if form.cleaned_data['redshift']:
+                    update_or_create_target_extra(target, 'Redshift', form.cleaned_data['redshift'])
             messages.success(self.request, f"Classification set to {classification}")
             if form.cleaned_data['redshift']:
-                update_or_create_target_extra(target, 'Redshift', form.cleaned_data['redshift'])
                 messages.success(self.request, f"Redshift set to {form.cleaned_data['redshift']}")
 
         return redirect(self.get_success_url())
@@ -309,9 +337,9 @@ class ObservationCreateView(OldObservationCreateView):
     def get_initial(self):
         initial = super().get_initial()
         target = self.get_target()
-        photometry = target.reduceddatum_set.filter(data_type='photometry')
-        if photometry.exists():
-            latest_photometry = photometry.latest().value
+        latest_photometry = target.reduceddatum_set.filter(data_type='photometry').order_by('-timestamp').first()
+        if latest_photometry is not None:
+            latest_photometry = latest_photometry.value
             if 'magnitude' in latest_photometry:
                 initial['magnitude'] = latest_photometry['magnitude']
             elif 'limit' in latest_photometry:
@@ -323,18 +351,20 @@ class TargetVettingView(LoginRequiredMixin, RedirectView):
     """
     View that runs or reruns the kilonova candidate vetting code and stores the results
     """
+    @cached_property
+    def target(self):
+        return Target.objects.get(pk=self.kwargs['pk'])
+
     def get(self, request, *args, **kwargs):
         """
-        Method that handles the GET requests for this view. Calls the kilonova vetting code.
+        Method that handles the GET requests for this view. Queues the kilonova vetting code to run asynchronously.
         """
-        target = Target.objects.get(pk=kwargs['pk'])
-        banners, tns_query_status = target_post_save(target, created=True)
-        for banner in banners:
-            messages.success(request, banner)
-
-        if tns_query_status is not None:
-            messages.add_message(request,99,tns_query_status)
-            
+        messages.info(request, f"Running kilonova candidate vetting on {self.target.name}. "
+                               "Refresh after ~1 minute to see the results.")
+        # the target page shows this status until the task replaces it with the results
+        cache.set(vetting_results_key(self.target.id), {'status': 'queued'}, VETTING_QUEUED_TIMEOUT)
+        dramatiq_msg = target_run_vetting.send(self.target.id)
+        logger.info(dramatiq_msg)
         return HttpResponseRedirect(self.get_redirect_url())
 
     def get_redirect_url(self):
@@ -347,6 +377,34 @@ class TargetVettingView(LoginRequiredMixin, RedirectView):
         referer = self.request.META.get('HTTP_REFERER', '/')
         return referer
 
+class TargetGroupVettingView(LoginRequiredMixin, RedirectView):
+    """
+    View that crossmatches all targets in a group with the static catalogs used for kilonova candidate vetting
+    """
+    def get(self, request, *args, **kwargs):
+        """
+        Method that handles the GET requests for this view. Queues the crossmatch to run asynchronously.
+        """
+        # vetting writes to every target in the group, so only allow it for groups the user can change
+        target_lists = get_objects_for_user(request.user, 'tom_targets.change_targetlist')
+        target_list = get_object_or_404(target_lists, pk=kwargs['pk'])
+        messages.info(request, f"Crossmatching targets in {target_list.name} with static catalogs. "
+                               "Refresh after ~1 minute to see the results.")
+        dramatiq_msg = target_list_run_vetting.send(target_list.id)
+        logger.info(dramatiq_msg)
+        return HttpResponseRedirect(self.get_redirect_url())
+
+    def get_redirect_url(self):
+        """
+        Returns redirect URL as specified in the HTTP_REFERER field of the request.
+
+        :returns: referer
+        :rtype: str
+        """
+        referer = self.request.META.get('HTTP_REFERER', '/')
+        return referer
+
+
 class TargetMPCView(LoginRequiredMixin, RedirectView):
     """
     View that runs or reruns the kilonova candidate vetting code and stores the results
@@ -358,9 +416,10 @@ class TargetMPCView(LoginRequiredMixin, RedirectView):
         # get all detections of the target in question
         phot = ReducedDatum.objects.filter(target_id=kwargs["pk"], data_type="photometry",
                                            value__magnitude__isnull=False)
-        if phot.exists():
+        latest_id = phot.order_by('-timestamp').values_list('id', flat=True).first()
+        if latest_id is not None:
             messages.info(request, "Running minor planet checker. Refresh after ~1 minute to see matches.")
-            dramatiq_msg = target_run_mpc.send(phot.latest().id)  # check the latest detection
+            dramatiq_msg = target_run_mpc.send(latest_id)  # check the latest detection
             logger.info(dramatiq_msg)
         else:
             messages.error(request, "Must have at least one photometric detection to run minor planet checker.")
@@ -439,7 +498,7 @@ class CSSFieldListView(FilterView):
 
 
 def generate_prog_file(css_credible_regions):
-    return ','.join([cr.survey_field.name for cr in css_credible_regions]) + '\n'
+    return ','.join([cr.survey_field_id for cr in css_credible_regions]) + '\n'  # the field name is its primary key
 
 
 def submit_to_css(css_credible_regions, event_id, request=None):
@@ -481,7 +540,7 @@ def create_observation_records(credible_regions, observation_id, user, facility,
                 scheduled_start=cr.scheduled_start,
             )
             cr.observation_record = record
-            cr.save()
+            cr.save(update_fields=['observation_record'])
             records.append(record)
     return records
 
@@ -491,19 +550,31 @@ class CSSFieldExportView(CSSFieldListView):
     View that handles the export of CSS Fields to .prog file(s).
     """
     def post(self, request, *args, **kwargs):
-        css_credible_regions = self.get_selected_fields(request)
+        try:
+            css_credible_regions = self.get_selected_fields(request)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
         text = ''.join([generate_prog_file(group) for group in css_credible_regions])
         return self.render_to_response(text)
 
     def get_selected_fields(self, request):
-        target_ids = None if request.POST.get('isSelectAll') == 'True' else request.POST.getlist('selected-target')
+        """Returns the selected fields in observing groups. Raises ``ValueError`` if the selection is malformed."""
+        if request.POST.get('isSelectAll') == 'True':
+            target_ids = None
+        else:
+            selection = request.POST.getlist('selected-target')
+            try:
+                target_ids = frozenset(int(x) for x in selection)
+            except ValueError:
+                logger.error('Invalid selection of CSS fields: %s', selection)
+                raise ValueError(f'Invalid selection of CSS fields: {", ".join(selection)}')
         localization = self.get_eventlocalization()
         credible_regions = localization.surveyfieldcredibleregions.filter(group__isnull=False)
         if target_ids is not None:
             credible_regions = credible_regions.filter(id__in=target_ids)
-        group_numbers = list(credible_regions.order_by('group').values_list('group', flat=True).distinct())
         # evaluate this as a list now to maintain the order
-        groups = [list(credible_regions.filter(group=g).order_by('rank_in_group')) for g in group_numbers]
+        ordered_regions = credible_regions.select_related('survey_field').order_by('group', 'rank_in_group')
+        groups = [list(group) for _, group in groupby(ordered_regions, key=attrgetter('group'))]
         return groups
 
     def render_to_response(self, text, **response_kwargs):
@@ -530,7 +601,11 @@ class CSSFieldSubmitView(LoginRequiredMixin, RedirectView, CSSFieldExportView):
         """
         Method that handles the POST requests for this view.
         """
-        css_credible_regions = self.get_selected_fields(request)
+        try:
+            css_credible_regions = self.get_selected_fields(request)
+        except ValueError as e:
+            messages.error(request, str(e))
+            return HttpResponseRedirect(self.get_redirect_url())
         nle = self.get_nonlocalizedevent()
         filenames = submit_to_css(css_credible_regions, nle.event_id, request=request)
         params = {'pos_angle': 0., 'depth': 20.5, 'depth_unit': 'ab_mag', 'band': 'open'}
@@ -12,12 +12,15 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 from .settings_local import *
+from pathlib import Path
 import os
-import tempfile
 
+# environment variables do not change after startup, so read them from one snapshot
+_env = dict(os.environ)
 
-# Build paths inside the project like this: os.path.join(BASE_DIR, ...)
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Build paths inside the project like this: str(BASE_DIR / ...)
+BASE_DIR = Path(__file__).resolve().parent.parent
 
 
 # Quick-start development settings - unsuitable for production
@@ -86,7 +89,7 @@ ROOT_URLCONF = 'saguaro_tom.urls'
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
-        'DIRS': [os.path.join(BASE_DIR, 'templates')],
+        'DIRS': [str(BASE_DIR / 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
@@ -124,11 +127,11 @@ DRAMATIQ_BROKER = {
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql_psycopg2',
-        'NAME': os.getenv('POSTGRES_DB', POSTGRES_DB),
-        'USER': os.getenv('POSTGRES_USER', POSTGRES_USER),
-        'PASSWORD': os.getenv('POSTGRES_PASSWORD', POSTGRES_PASSWORD),
-        'HOST': os.getenv('POSTGRES_HOST', POSTGRES_HOST),
-        'PORT': os.getenv('POSTGRES_PORT', int(POSTGRES_PORT)),
+        'NAME': _env.get('POSTGRES_DB', POSTGRES_DB),
+        'USER': _env.get('POSTGRES_USER', POSTGRES_USER),
+        'PASSWORD': _env.get('POSTGRES_PASSWORD', POSTGRES_PASSWORD),
+        'HOST': _env.get('POSTGRES_HOST', POSTGRES_HOST),
+        'PORT': _env.get('POSTGRES_PORT', int(POSTGRES_PORT)),
     }
 }
 
@@ -183,9 +186,9 @@ DATE_FORMAT = 'Y-m-d'
 
 WHITENOISE_STATIC_PREFIX = '/static/'  # TODO: delete this when whitenoise Issue #271 is resolved
 STATIC_URL = FORCE_SCRIPT_NAME + '/static/'
-STATIC_ROOT = os.path.join(BASE_DIR, '_static')
-STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
-MEDIA_ROOT = os.path.join(BASE_DIR, 'data')
+STATIC_ROOT = str(BASE_DIR / '_static')
+STATICFILES_DIRS = [str(BASE_DIR / 'static')]
+MEDIA_ROOT = str(BASE_DIR / 'data')
 MEDIA_URL = FORCE_SCRIPT_NAME + '/data/'
 
 LOGGING = {
@@ -205,12 +208,13 @@ LOGGING = {
 }
 
 # Caching
-# https://docs.djangoproject.com/en/dev/topics/cache/#filesystem-caching
+# https://docs.djangoproject.com/en/dev/topics/cache/#redis
+# shared by the web workers and the dramatiq workers, so use the same Redis server as the broker (separate database)
 
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
-        'LOCATION': tempfile.gettempdir()
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': _env.get('REDIS_URL', 'redis://localhost:6379/1')
     }
 }
 
@@ -260,7 +264,7 @@ SINGLE_TARGET_DATA_SERVICES = {
     'ATLAS': {
         'class': 'custom_code.atlas.CustomAtlasForcedPhotometryService',
         'url': "https://fallingstar-data.com/forcedphot",
-        'api_key': os.getenv('ATLAS_FORCED_PHOTOMETRY_API_KEY', ATLAS_API_KEY)
+        'api_key': _env.get('ATLAS_FORCED_PHOTOMETRY_API_KEY', ATLAS_API_KEY)
     },
 }
 
@@ -366,10 +370,10 @@ HOOKS = {
 
 DATA_SHARING = {
     'tom-demo': {
-        'DISPLAY_NAME': os.getenv('TOM_DEMO_DISPLAY_NAME', 'TOM Demo'),
-        'BASE_URL': os.getenv('TOM_DEMO_BASE_URL', 'https://tom-demo.lco.global/'),
-        'USERNAME': os.getenv('TOM_DEMO_USERNAME', 'guest'),
-        'PASSWORD': os.getenv('TOM_DEMO_PASSWORD', 'guest'),
+        'DISPLAY_NAME': _env.get('TOM_DEMO_DISPLAY_NAME', 'TOM Demo'),
+        'BASE_URL': _env.get('TOM_DEMO_BASE_URL', 'https://tom-demo.lco.global/'),
+        'USERNAME': _env.get('TOM_DEMO_USERNAME', 'guest'),
+        'PASSWORD': _env.get('TOM_DEMO_PASSWORD', 'guest'),
     },
 }
 
@@ -396,10 +400,10 @@ ALERT_STREAMS = [
         'NAME': 'tom_alertstreams.alertstreams.hopskotch.HopskotchAlertStream',
         'OPTIONS': {
             'URL': 'kafka://kafka.scimma.org/',
-            'GROUP_ID': os.getenv('SCIMMA_AUTH_USERNAME', SCIMMA_AUTH_USERNAME)
-                        + '-' + os.getenv('HOPSKOTCH_GROUP_ID', HOPSKOTCH_GROUP_ID),
-            'USERNAME': os.getenv('SCIMMA_AUTH_USERNAME', SCIMMA_AUTH_USERNAME),
-            'PASSWORD': os.getenv('SCIMMA_AUTH_PASSWORD', SCIMMA_AUTH_PASSWORD),
+            'GROUP_ID': _env.get('SCIMMA_AUTH_USERNAME', SCIMMA_AUTH_USERNAME)
+                        + '-' + _env.get('HOPSKOTCH_GROUP_ID', HOPSKOTCH_GROUP_ID),
+            'USERNAME': _env.get('SCIMMA_AUTH_USERNAME', SCIMMA_AUTH_USERNAME),
+            'PASSWORD': _env.get('SCIMMA_AUTH_PASSWORD', SCIMMA_AUTH_PASSWORD),
             'TOPIC_HANDLERS': {
                 'gcn.notices.einstein_probe.wxt.alert': 'custom_code.alertstream_handlers.handle_einstein_probe_alert',
                 'igwn.gwalert': 'custom_code.alertstream_handlers.handle_message_and_send_alerts'
@@ -408,17 +412,17 @@ ALERT_STREAMS = [
     },
 ]
 
-VUE_FRONTEND_DIR_TOM_NONLOCAL = os.path.join(STATIC_ROOT, 'tom_nonlocalizedevents/vue')
+VUE_FRONTEND_DIR_TOM_NONLOCAL = str(Path(STATIC_ROOT, 'tom_nonlocalizedevents', 'vue'))
 WEBPACK_LOADER = {
     'TOM_NONLOCALIZEDEVENTS': {
         'CACHE': not DEBUG,
         'BUNDLE_DIR_NAME': 'tom_nonlocalizedevents/vue/',  # must end with slash
-        'STATS_FILE': os.path.join(VUE_FRONTEND_DIR_TOM_NONLOCAL, 'webpack-stats.json'),
+        'STATS_FILE': str(Path(VUE_FRONTEND_DIR_TOM_NONLOCAL, 'webpack-stats.json')),
         'POLL_INTERVAL': 0.1,
         'TIMEOUT': None,
         'IGNORE': [r'.+\.hot-update.js', r'.+\.map']
     }
 }
-TOM_API_URL = os.getenv('TOM_API_URL', os.path.join(ALLOWED_HOST, FORCE_SCRIPT_NAME))
-HERMES_API_URL = os.getenv('HERMES_API_URL', 'https://hermes.lco.global')
+TOM_API_URL = _env.get('TOM_API_URL', os.path.join(ALLOWED_HOST, FORCE_SCRIPT_NAME))
+HERMES_API_URL = _env.get('HERMES_API_URL', 'https://hermes.lco.global')
 CREDIBLE_REGION_PROBABILITIES = '[0.25, 0.5, 0.75, 0.9, 0.95]'
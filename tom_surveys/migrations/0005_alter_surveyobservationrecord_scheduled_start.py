@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tom_surveys", "0004_alter_surveyobservationrecord_options"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="surveyobservationrecord",
+            name="scheduled_start",
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
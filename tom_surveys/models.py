@@ -67,7 +67,7 @@ class SurveyObservationRecord(models.Model):
     parameters = models.JSONField()
     observation_id = models.CharField(max_length=255)
     status = models.CharField(max_length=200)
-    scheduled_start = models.DateTimeField(null=True)
+    scheduled_start = models.DateTimeField(null=True, db_index=True)
     scheduled_end = models.DateTimeField(null=True)
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
@@ -3,8 +3,8 @@ from tom_nonlocalizedevents.models import NonLocalizedEvent
 from tom_surveys.models import SurveyObservationRecord
 from ...reporting import report_to_treasure_map
 from custom_code.filters import LocalizationFilter
-from astropy.time import Time, TimezoneInfo
-from astropy import units as u
+from django.utils import timezone
+from datetime import timedelta
 import logging
 
 
@@ -14,11 +14,12 @@ logger = logging.getLogger(__name__)
 def get_active_nonlocalizedevents(t0=None, lookback_days=3., test=False):
     """
     Returns a queryset containing "active" NonLocalizedEvents, significant events that happened less than
-    `lookback_days` before `t0` and have not been retracted. Use `test=True` to query mock events instead of real ones.
+    `lookback_days` before `t0` (a UTC datetime, default now) and have not been retracted. Use `test=True` to query mock
+    events instead of real ones.
     """
     if t0 is None:
-        t0 = Time.now()
-    lookback_window_nle = (t0 - lookback_days * u.day).isot
+        t0 = timezone.now()
+    lookback_window_nle = (t0 - timedelta(days=lookback_days)).strftime('%Y-%m-%dT%H:%M:%S.%f')
     active_nles = NonLocalizedEvent.objects.filter(sequences__details__time__gte=lookback_window_nle, state='ACTIVE')
     active_nles = active_nles.exclude(sequences__details__significant=False)
     if test:
@@ -42,8 +43,8 @@ class Command(BaseCommand):
         parser.add_argument('--test', action='store_true', help='Report pointings for test events only')
 
     def handle(self, lookback_days_nle=3., lookback_days_obs=1., contour_percent=95., test=False, **kwargs):
-        now = Time.now()
-        lookback_window_obs = now - lookback_days_obs * u.day
+        now = timezone.now()
+        lookback_window_obs = now - timedelta(days=lookback_days_obs)
         active_nles = get_active_nonlocalizedevents(lookback_window_obs, lookback_days_nle, test=test)
         active_nles = active_nles.filter(event_type=NonLocalizedEvent.NonLocalizedEventType.GRAVITATIONAL_WAVE)
         if not active_nles.exists():
@@ -51,8 +52,7 @@ class Command(BaseCommand):
             return
         logger.info(f'Found active GW events: {", ".join([nle.event_id for nle in active_nles])}')
 
-        recent_obs = SurveyObservationRecord.objects.filter(created__gt=lookback_window_obs.to_datetime(TimezoneInfo()),
-                                                            created__lte=now.to_datetime(TimezoneInfo()))
+        recent_obs = SurveyObservationRecord.objects.filter(created__gt=lookback_window_obs, created__lte=now)
         loc_filter = LocalizationFilter()
         for nle in active_nles:
             matching_observations = loc_filter.filter(recent_obs, (nle, contour_percent, lookback_days_nle))
@@ -16,6 +16,8 @@ class TreasureMapPointingListView(FilterView):
     paginate_by = 100
     strict = False
     model = TreasureMapPointing
+    # the table shows the event and the observation record and its field for every pointing
+    queryset = TreasureMapPointing.objects.select_related('nonlocalizedevent', 'observation_record__survey_field')
     filterset_class = TreasureMapPointingFilter
 
     def get_context_data(self, *, object_list=None, **kwargs):